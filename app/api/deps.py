@@ -94,15 +94,10 @@ def get_session_service(
 
 def get_llm_service():
     """获取LLM服务实例"""
-    from app.services.ai.llm.llm_factory import LLMFactory
-    from app.core.config import settings
-    import os
-    
-    # 从环境变量获取，如果不存在则使用默认值
-    model_type = os.getenv("DEFAULT_MODEL_TYPE", "deepseek")
+    from app.services.ai.llm.llm_factory import llm_factory
     
-    factory = LLMFactory()
-    return factory.get_llm_service(model_type)
+    # 未指定模型类型时使用默认模型，服务实例在进程内共享
+    return llm_factory.get_llm_service()
 
 def get_role_selector():
     """获取角色选择器实例"""
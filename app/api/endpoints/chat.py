@@ -4,6 +4,7 @@ from typing import Optional
 
 from app.api.deps import get_chat_service, get_memory_service
 from app.services.chat_service import ChatService
+from app.services.formatters import SSEFormatter
 from app.services.ai.memory.memory_service import MemoryService
 from app.utils.exceptions import handle_exceptions
 from app.utils.logging import logger
@@ -35,23 +36,24 @@ async def chat_stream(
     session_id: str,
     user_id: Optional[str] = "anonymous",
     show_thinking: Optional[bool] = Query(False),
+    chunk_mode: str = Query("token", pattern="^(token|sentence)$"),
     chat_service: ChatService = Depends(get_chat_service)
 ):
     """
     流式聊天API端点，使用SSE传输
+
+    chunk_mode 为 sentence 时按完整句子推送内容，便于TTS等下游按句处理
     """
-    async def event_generator():
-        async for chunk in chat_service.chat_stream(
+    # chat_stream 直接产出编码好的SSE帧(bytes)，无需再包一层生成器转发
+    return StreamingResponse(
+        chat_service.chat_stream(
             session_id=session_id,
             message=message,
             user_id=user_id,
             show_thinking=show_thinking,
-            format="sse"
-        ):
-            yield chunk
-    
-    return StreamingResponse(
-        event_generator(),
+            format="sse",
+            chunk_mode=chunk_mode
+        ),
         media_type="text/event-stream",
         headers={
             "Content-Type": "text/event-stream; charset=utf-8",
@@ -85,7 +87,7 @@ async def chat_stream_rag(
                 yield chunk
         except Exception as e:
             logger.error(f"生成RAG流式响应出错: {str(e)}", exc_info=True)
-            yield f"data: {{'error': '{str(e)}'}}\n\n"
+            yield SSEFormatter.static_frame({"event": "error", "message": str(e)})
     
     return StreamingResponse(
         event_generator(),
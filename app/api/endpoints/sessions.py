@@ -120,18 +120,8 @@ class SessionController:
         # 添加更新时间
         session.updated_at = datetime.utcnow()
         
-        # 更新MongoDB
-        updated_session = await session_service.session_repository.update(session)
-        
-        # 同步更新到Redis
-        if session_service.redis_service:
-            # 转换为字典
-            session_dict = updated_session.model_dump()
-            # 保存到Redis
-            await session_service.redis_service.set_session(
-                session_id=session_id,
-                session_data=session_dict
-            )
+        # 更新MongoDB，并删除Redis中的会话缓存
+        updated_session = await session_service.update_session(session_id, session)
         
         return updated_session
 
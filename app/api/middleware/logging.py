@@ -14,7 +14,7 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
     
     async def dispatch(self, request: Request, call_next: Callable) -> Response:
         # 生成请求ID并存储在请求状态中
-        request_id = str(uuid.uuid4())
+        request_id = uuid.uuid4().hex
         request.state.request_id = request_id
         
         # 获取带请求ID的日志记录器
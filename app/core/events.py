@@ -1,3 +1,4 @@
+import asyncio
 from typing import Callable
 from fastapi import FastAPI
 from app.core.config import settings
@@ -22,6 +23,10 @@ def startup_event_handler(app: FastAPI) -> Callable:
             }
         )
         
+        # uvicorn默认(loop="auto")在已安装uvloop时自动使用，记录实际的事件循环实现便于确认
+        loop = asyncio.get_running_loop()
+        logger.info("Event loop: %s.%s", type(loop).__module__, type(loop).__name__)
+        
         # 添加数据库连接日志
         logger.info("Initializing database connections...")
         
@@ -56,6 +61,13 @@ def shutdown_event_handler(app: FastAPI) -> Callable:
         # 记录应用关闭
         logger.info(f"Shutting down application {settings.PROJECT_NAME}")
         
+        # 关闭共享的LLM HTTP连接池
+        try:
+            from app.services.ai.llm.deepseek_service import close_http_client
+            await close_http_client()
+        except Exception as e:
+            logger.error("Failed to close LLM HTTP client: %s", e)
+        
         # 其他关闭逻辑
         # ...
         
@@ -1,7 +1,101 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, AsyncGenerator, List
+from typing import Dict, Any, Optional, AsyncGenerator, List, Pattern, Tuple
 import re
 
+# 情绪『...』与动作【...】标记，模块加载时编译一次
+_EMOTION_RE = re.compile(r'『([\w]+)』')
+_ACTION_RE = re.compile(r'【([^】\n]*)】')
+# 一次扫描同时匹配两种标记
+_TAG_RE = re.compile(r'『(?P<emotion>\w+)』|【(?P<action>[^】\n]*)】')
+
+
+# 标记起始符，用于查找尚未闭合、之后仍可能匹配的标记
+_TAG_OPENER_RE = re.compile(r'[『【]')
+
+
+def extract_tags(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """单次扫描文本，返回首个情绪标签和首个动作描述"""
+    # 大多数文本不含标记，先用子串查找快速排除，避免启动正则扫描
+    if '』' not in text and '】' not in text:
+        return None, None
+    emotion, action, _ = scan_tags(text)
+    return emotion, action
+
+
+def scan_tags(
+    text: str,
+    pos: int = 0,
+    tag_re: Pattern = _TAG_RE,
+    emotion_re: Optional[Pattern] = _EMOTION_RE,
+) -> Tuple[Optional[str], Optional[str], int]:
+    """从pos开始扫描文本，返回首个情绪标签、首个动作描述和下次扫描的起始位置
+
+    起始位置为最后一个匹配标记的结束位置；若其前存在尚未闭合且未被换行截断的起始符，
+    则为该起始符位置（之后到来的结束符仍可能使其匹配）。
+
+    Args:
+        text: 已累积的完整文本
+        pos: 开始扫描的位置，即上次扫描返回的起始位置
+        tag_re: 含 emotion/action 命名分组的标记正则，调用方可使用各自的标记语法
+        emotion_re: 情绪标签出现在动作描述内部时用于单独查找情绪的正则，为None时不查找
+    """
+    emotion = None
+    action = None
+    # 标记内容不能跨行，最后一个换行之前未闭合的起始符不会再匹配
+    open_from = text.rfind('\n') + 1
+    resume = None
+    cursor = pos
+    for match in tag_re.finditer(text, pos):
+        if resume is None:
+            opener = _TAG_OPENER_RE.search(text, max(cursor, open_from), match.start())
+            if opener:
+                resume = opener.start()
+        cursor = match.end()
+        if match.group('emotion') is not None:
+            if emotion is None:
+                emotion = match.group('emotion')
+        else:
+            if action is None:
+                action = match.group('action')
+            if emotion is None and emotion_re is not None and '』' in match.group('action'):
+                # 情绪标签出现在动作描述内部时会被动作匹配吞掉，单独查找首个情绪标签
+                found = emotion_re.search(text, pos)
+                emotion = found.group(1) if found else None
+        if emotion is not None and action is not None:
+            break
+    if resume is None:
+        opener = _TAG_OPENER_RE.search(text, max(cursor, open_from))
+        resume = opener.start() if opener else cursor
+    return emotion, action, resume
+
+
+class TagTracker:
+    """流式回复的情绪/动作跟踪器
+
+    以片段列表累积回复内容，只有新片段包含标记结束符时才扫描，
+    且只从上次扫描停下的位置继续，首个情绪和动作都找到后不再扫描。
+    """
+    
+    __slots__ = ('parts', 'emotion', 'action', 'scan_pos')
+    
+    def __init__(self):
+        self.parts: List[str] = []
+        self.emotion: Optional[str] = None
+        self.action: Optional[str] = None
+        self.scan_pos = 0  # 之前的内容已扫描过，下次从该位置继续
+    
+    def feed(self, content: str) -> Tuple[Optional[str], Optional[str]]:
+        """追加一个增量片段，返回当前的情绪标签和动作描述"""
+        self.parts.append(content)
+        if (self.emotion is None or self.action is None) and ('』' in content or '】' in content):
+            emotion, action, self.scan_pos = scan_tags("".join(self.parts), self.scan_pos)
+            if self.emotion is None:
+                self.emotion = emotion
+            if self.action is None:
+                self.action = action
+        return self.emotion, self.action
+
+
 class BaseLLMService(ABC):
     """LLM服务抽象基类 - 定义所有模型必须实现的接口"""
     
@@ -46,9 +140,19 @@ class BaseLLMService(ABC):
         pass
 
     def extract_emotion(self, text):
-        """从文本中提取情绪标签"""
-        emotion_pattern = r'『([\w]+)』'
-        match = re.search(emotion_pattern, text)
+        """从文本中提取情绪标签
+        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
+        """
+        match = _EMOTION_RE.search(text)
+        if match:
+            return match.group(1)
+        return None
+        
+    def extract_action(self, text):
+        """从文本中提取动作描述
+        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
+        """
+        match = _ACTION_RE.search(text)
         if match:
             return match.group(1)
         return None
@@ -1,5 +1,5 @@
 import os
-import json
+import orjson
 import logging
 from typing import Any, Dict, List, Mapping, Optional, Iterator, AsyncIterator, Union, Literal, ClassVar
 import httpx
@@ -162,7 +162,6 @@ class DeepSeekChatModel(BaseChatModel):
                 ) as response:
                     response.raise_for_status()
                     
-                    content = ""
                     async for line in response.aiter_lines():
                         if not line.strip() or line.strip() == "data: [DONE]":
                             continue
@@ -171,18 +170,18 @@ class DeepSeekChatModel(BaseChatModel):
                             logger.warning(f"收到意外的数据格式: {line}")
                             continue
                             
-                        json_data = json.loads(line[6:])
+                        json_data = orjson.loads(line[6:])
                         delta = json_data.get("choices", [{}])[0].get("delta", {})
                         
                         if "content" in delta and delta["content"]:
-                            content += delta["content"]
                             chunks.append(delta["content"])
                             
                             # 回调通知
                             if run_manager:
                                 await run_manager.on_llm_new_token(delta["content"])
                     
-                    # 创建最终结果
+                    # 创建最终结果，增量内容在结束时一次性拼接
+                    content = "".join(chunks)
                     final_response = {
                         "choices": [
                             {
@@ -249,7 +248,7 @@ class DeepSeekChatModel(BaseChatModel):
                         logger.warning(f"收到意外的数据格式: {line}")
                         continue
                         
-                    json_data = json.loads(line[6:])
+                    json_data = orjson.loads(line[6:])
                     delta = json_data.get("choices", [{}])[0].get("delta", {})
                     
                     if "content" in delta and delta["content"]:
@@ -6,7 +6,7 @@ from langchain_core.exceptions import OutputParserException
 from dotenv import load_dotenv, find_dotenv
 import httpx
 import json
-import re
+import orjson
 import uuid
 import time
 from app.utils.logging import logger, AILogger, LogContext, merge_extra_data
@@ -45,7 +45,32 @@ else:
     logger.error("[ENV诊断-2] DEEPSEEK_API_KEY环境变量未加载!")
 
 from .deepseek_model import DeepSeekChatModel
-from .base_llm_service import BaseLLMService
+from .base_llm_service import BaseLLMService, TagTracker
+
+# 进程内共享的HTTP客户端，复用连接池，避免每次请求重新建立TCP/TLS连接
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的HTTP客户端，首次调用或已关闭时创建"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 1000)),
+                max_keepalive_connections=int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", 200))
+            ),
+            timeout=httpx.Timeout(60.0)
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """关闭共享的HTTP客户端，在应用关闭时调用"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
 
 class DeepseekService(BaseLLMService):
     """DeepSeek模型服务实现"""
@@ -103,16 +128,16 @@ class DeepseekService(BaseLLMService):
         
         try:
             # 调用DeepSeek API
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=params,
-                    timeout=60.0
-                )
+            client = get_http_client()
+            response = await client.post(
+                f"{self.api_base}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                json=params,
+                timeout=60.0
+            )
             
             response.raise_for_status()
             result = response.json()
@@ -147,7 +172,7 @@ class DeepseekService(BaseLLMService):
         messages = ModelAdapter.build_messages(message, system_prompt, history)
         
         if history:
-            logger.info(f"历史消息示例: {history[:1]}")
+            logger.info("历史消息示例: %s", history[:1])
             #logger.info(f"构建后的完整消息列表: {messages}")
 
         # 构建参数
@@ -162,45 +187,42 @@ class DeepseekService(BaseLLMService):
         if "max_tokens" in kwargs:
             params["max_tokens"] = kwargs["max_tokens"]
         
-        request_id = str(uuid.uuid4())
+        request_id = uuid.uuid4().hex
         ai_logger = AILogger(model_id=self.model_name, request_id=request_id)
         
         ai_logger.log_prompt(prompt=message, role_id=kwargs.get('role_id'))
         start_time = time.time()
         
-        content_buffer = ""  # 添加内容缓冲区
+        tags = TagTracker()  # 累积内容并跟踪情绪和动作
         
         try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream(
-                    "POST",
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=params,
-                    timeout=60.0
-                ) as response:
-                    response.raise_for_status()
+            client = get_http_client()
+            async with client.stream(
+                "POST",
+                f"{self.api_base}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                json=params,
+                timeout=60.0
+            ) as response:
+                response.raise_for_status()
                     
-                    async for line in response.aiter_lines():
-                        if line.startswith("data:") and not line.startswith("data: [DONE]"):
-                            chunk = json.loads(line[5:])
-                            if chunk["choices"][0]["delta"].get("content"):
-                                content = chunk["choices"][0]["delta"]["content"]
-                                content_buffer += content  # 累积内容
+                async for line in response.aiter_lines():
+                    if line.startswith("data:") and not line.startswith("data: [DONE]"):
+                        chunk = orjson.loads(line[5:])
+                        if chunk["choices"][0]["delta"].get("content"):
+                            content = chunk["choices"][0]["delta"]["content"]
+                            # 累积内容并提取情绪和动作
+                            emotion, action = tags.feed(content)
                                 
-                                # 提取情绪和动作
-                                emotion = self.extract_emotion(content_buffer)
-                                action = self.extract_action(content_buffer)
-                                
-                                # 返回包含情绪和动作的响应
-                                yield {
-                                    "content": content,
-                                    "emotion": emotion,
-                                    "action": action
-                                }
+                            # 返回包含情绪和动作的响应
+                            yield {
+                                "content": content,
+                                "emotion": emotion,
+                                "action": action
+                            }
         except Exception as e:
             logger.exception(f"DeepSeek流式API调用异常: {str(e)}")
             yield {
@@ -226,29 +248,9 @@ class DeepseekService(BaseLLMService):
             }
         }
 
-    def extract_emotion(self, text):
-        """从文本中提取情绪标签
-        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
-        """
-        emotion_pattern = r'『([\w]+)』'
-        match = re.search(emotion_pattern, text)
-        if match:
-            return match.group(1)
-        return None
-        
-    def extract_action(self, text):
-        """从文本中提取动作描述
-        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
-        """
-        action_pattern = r'【(.*?)】'
-        match = re.search(action_pattern, text)
-        if match:
-            return match.group(1)
-        return None
-    
     async def generate_stream_with_emotion(self, message, system_prompt=None, **kwargs):
         """带情绪检测的流式生成"""
-        content_buffer = ""
+        tags = TagTracker()
         
         # 处理消息格式
         messages = []
@@ -262,11 +264,8 @@ class DeepseekService(BaseLLMService):
             if not content:  # 跳过空内容
                 continue
             
-            content_buffer += content
-            
             # 检查情绪和动作
-            emotion = self.extract_emotion(content_buffer)
-            action = self.extract_action(content_buffer)
+            emotion, action = tags.feed(content)
             
             yield {
                 "content": content,
@@ -280,23 +279,29 @@ class DeepseekService(BaseLLMService):
         temperature = kwargs.get("temperature", 0.7)
         max_tokens = kwargs.get("max_tokens", 1000)
         
-        # 详细记录LLM请求参数
-        logger.info(f"LLM请求配置: stream={stream}, temperature={temperature}, max_tokens={max_tokens}")
-        
-        # 记录消息结构和内容摘要
-        system_messages = [m for m in messages if m["role"] == "system"]
-        user_messages = [m for m in messages if m["role"] == "user"]
-        assistant_messages = [m for m in messages if m["role"] == "assistant"]
-        
-        logger.info(f"LLM输入消息统计: 系统消息={len(system_messages)}, 用户消息={len(user_messages)}, 助手消息={len(assistant_messages)}")
-        
-        if system_messages:
-            logger.info(f"系统消息内容(截取): {system_messages[0]['content'][:100]}...")
-        
-        # 记录最后几条消息
-        last_messages = messages[-3:] if len(messages) > 3 else messages
-        for i, msg in enumerate(last_messages):
-            logger.info(f"最近消息[{i}]: role={msg['role']}, content_preview={msg['content'][:50]}..., 完整长度={len(msg['content'])}")
+        # 详细记录LLM请求参数，需要遍历全部消息，仅在INFO级别启用时计算
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("LLM请求配置: stream=%s, temperature=%s, max_tokens=%s", stream, temperature, max_tokens)
+            
+            # 记录消息结构和内容摘要，一次遍历完成分类计数
+            role_counts = {"system": 0, "user": 0, "assistant": 0}
+            first_system = None
+            for m in messages:
+                role = m["role"]
+                if role in role_counts:
+                    role_counts[role] += 1
+                if first_system is None and role == "system":
+                    first_system = m
+            
+            logger.info("LLM输入消息统计: 系统消息=%d, 用户消息=%d, 助手消息=%d",
+                        role_counts["system"], role_counts["user"], role_counts["assistant"])
+            
+            if first_system is not None:
+                logger.info("系统消息内容(截取): %s...", first_system['content'][:100])
+            
+            # 记录最后几条消息
+            for i, msg in enumerate(messages[-3:]):
+                logger.info("最近消息[%d]: role=%s, content_preview=%s..., 完整长度=%d", i, msg['role'], msg['content'][:50], len(msg['content']))
         
         # 添加实际LLM调用
         params = {
@@ -307,16 +312,16 @@ class DeepseekService(BaseLLMService):
             "stream": stream
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.api_base}/chat/completions",
-                headers={"Authorization": f"Bearer {self.api_key}"},
-                json=params,
-                timeout=60.0
-            )
+        client = get_http_client()
+        response = await client.post(
+            f"{self.api_base}/chat/completions",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json=params,
+            timeout=60.0
+        )
 
         result = response.json()
-        logger.info(f"LLM响应完成: 响应类型={'流式' if stream else '完整'}")
+        logger.info("LLM响应完成: 响应类型=%s", '流式' if stream else '完整')
         return result
 
     def log_completion(self, completion, **kwargs):
@@ -325,4 +330,4 @@ class DeepseekService(BaseLLMService):
                 'completion_preview': completion[:100] + "..." if len(completion) > 100 else completion
             }
         })
-        logger.info(f"DeepSeek返回: 长度={len(completion)}", extra=extra)
+        logger.info("DeepSeek返回: 长度=%d", len(completion), extra=extra)
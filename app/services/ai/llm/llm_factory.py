@@ -7,11 +7,16 @@ import os
 # 如需支持更多模型，添加以下导入
 # from langchain_community.chat_models import ChatOpenAI, ChatQianWen
 
+# 默认模型类型，导入时读取一次（上面导入的模型服务模块已加载.env）
+_DEFAULT_MODEL_TYPE = os.getenv("DEFAULT_MODEL_TYPE", "deepseek")
+
 class LLMFactory:
     """LLM服务工厂，支持动态注册和创建模型服务"""
     
     # 模型服务注册表
     _registry: Dict[str, Type[BaseLLMService]] = {}
+    # 已创建的服务实例，按模型类型在所有工厂实例间共享，复用底层HTTP连接
+    _instances: Dict[str, BaseLLMService] = {}
     
     @classmethod
     def register(cls, name: str, service_class: Type[BaseLLMService]) -> None:
@@ -26,19 +31,13 @@ class LLMFactory:
         
         return cls._registry[model_type]()
     
-    @classmethod
-    def get_llm_service(cls, model_type: str) -> BaseLLMService:
-        """兼容旧接口，调用create方法"""
-        print(f"获取LLM服务--指定model_type--: {model_type}")
-        return cls.create(model_type)
-
     def get_llm_service(self, model_type=None):
         """获取LLM服务实例
         
         Args:
             model_type: 可选的模型类型，如果为None则使用环境变量配置
         """
-        model_type = model_type or os.getenv("DEFAULT_MODEL_TYPE", "deepseek")
+        model_type = model_type or _DEFAULT_MODEL_TYPE
         
         if model_type == "qianwen":
             return self._get_qianwen_service()
@@ -49,15 +48,21 @@ class LLMFactory:
     
     # 使用下划线前缀表示这是私有辅助方法
     def _get_deepseek_service(self):
-        """获取DeepSeek服务（惰性加载）"""
-        if not hasattr(self, '_deepseek_service'):
+        """获取DeepSeek服务（惰性加载，进程内共享）"""
+        service = LLMFactory._instances.get("deepseek")
+        if service is None:
             from app.services.ai.llm.deepseek_service import DeepseekService
-            self._deepseek_service = DeepseekService()
-        return self._deepseek_service
+            service = LLMFactory._instances["deepseek"] = DeepseekService()
+        return service
 
     def _get_qianwen_service(self):
-        """获取Qianwen服务实例"""
-        if not hasattr(self, '_qianwen_service'):
+        """获取Qianwen服务实例（惰性加载，进程内共享）"""
+        service = LLMFactory._instances.get("qianwen")
+        if service is None:
             from app.services.ai.llm.qianwen_service import QianwenService
-            self._qianwen_service = QianwenService()
-        return self._qianwen_service
+            service = LLMFactory._instances["qianwen"] = QianwenService()
+        return service
+
+
+# 进程内共享的工厂实例，调用方直接复用，无需每次请求创建
+llm_factory = LLMFactory()
@@ -3,6 +3,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# API接受的消息角色
+_VALID_ROLES = frozenset(("system", "user", "assistant"))
+
 class ModelAdapter:
     """适配不同模型API的参数转换器"""
     
@@ -112,10 +115,15 @@ class ModelAdapter:
                 if not isinstance(msg, dict) or "role" not in msg or "content" not in msg:
                     logger.warning(f"跳过格式不正确的历史消息: {msg}")
                     continue
+                
+                # 已是标准格式的消息（记忆服务构建的历史）直接复用，不再逐条复制
+                if len(msg) == 2 and msg["role"] in _VALID_ROLES:
+                    messages.append(msg)
+                    continue
                     
                 # 规范化角色名称
                 role = msg["role"].lower()
-                if role not in ["system", "user", "assistant"]:
+                if role not in _VALID_ROLES:
                     if role == "bot" or role == "ai":
                         role = "assistant"
                     else:
@@ -127,6 +135,6 @@ class ModelAdapter:
         messages.append({"role": "user", "content": message})
         
         # 记录构建的消息数量
-        logger.info(f"构建了{len(messages)}条消息，包含系统提示:{bool(system_prompt)}，历史消息:{len(history) if history else 0}条")
+        logger.info("构建了%d条消息，包含系统提示:%s，历史消息:%d条", len(messages), bool(system_prompt), len(history) if history else 0)
         
         return messages
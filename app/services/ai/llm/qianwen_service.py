@@ -2,14 +2,13 @@ import os
 import logging
 from typing import Dict, Any, Optional, AsyncGenerator, List
 from dotenv import load_dotenv
-import re
 import json
 
 from langchain_core.messages import HumanMessage, SystemMessage
 from dashscope import Generation
 from dashscope.api_entities.dashscope_response import DashScopeAPIResponse
 
-from app.services.ai.llm.base_llm_service import BaseLLMService
+from app.services.ai.llm.base_llm_service import BaseLLMService, TagTracker
 from .model_adapter import ModelAdapter
 
 load_dotenv()
@@ -125,7 +124,7 @@ class QianwenService(BaseLLMService):
         messages = ModelAdapter.build_messages(message, system_prompt, history)
         
         if history:
-            logger.info(f"历史消息示例: {history[:1]}")
+            logger.info("历史消息示例: %s", history[:1])
             #logger.info(f"构建后的完整消息列表: {messages}")
         
         try:
@@ -179,29 +178,9 @@ class QianwenService(BaseLLMService):
             }
         }
 
-    def extract_emotion(self, text):
-        """从文本中提取情绪标签
-        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
-        """
-        emotion_pattern = r'『([\w]+)』'
-        match = re.search(emotion_pattern, text)
-        if match:
-            return match.group(1)
-        return None
-        
-    def extract_action(self, text):
-        """从文本中提取动作描述
-        示例: 『信任』"博士，这次行动交给你了。"【轻触地图】
-        """
-        action_pattern = r'【(.*?)】'
-        match = re.search(action_pattern, text)
-        if match:
-            return match.group(1)
-        return None
-    
     async def generate_stream_with_emotion(self, message, system_prompt=None, **kwargs):
         """带情绪检测的流式生成"""
-        content_buffer = ""
+        tags = TagTracker()
         
         # 处理消息格式
         messages = []
@@ -215,11 +194,8 @@ class QianwenService(BaseLLMService):
             if not content:  # 跳过空内容
                 continue
             
-            content_buffer += content
-            
             # 检查情绪和动作
-            emotion = self.extract_emotion(content_buffer)
-            action = self.extract_action(content_buffer)
+            emotion, action = tags.feed(content)
             
             yield {
                 "content": content,
@@ -229,11 +205,12 @@ class QianwenService(BaseLLMService):
 
     async def chat_completion(self, messages: List[Dict[str, str]], **kwargs):
         """修改对话历史格式化方法，确保历史消息被LLM正确处理"""
-        logger.info(f"千问模型接收到{len(messages)}条消息")
+        logger.info("千问模型接收到%d条消息", len(messages))
         
-        # 更详细的日志，确保消息被正确处理
-        for i, msg in enumerate(messages):
-            logger.info(f"原始消息[{i}]详情: role={msg.get('role')}, role_name={msg.get('role_name')}, content长度={len(msg.get('content', ''))}")
+        # 逐条消息的详情仅在DEBUG级别输出
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, msg in enumerate(messages):
+                logger.debug("原始消息[%d]详情: role=%s, role_name=%s, content长度=%d", i, msg.get('role'), msg.get('role_name'), len(msg.get('content', '')))
         
         # 改进标准化逻辑
         standardized_messages = []
@@ -251,7 +228,7 @@ class QianwenService(BaseLLMService):
             
             standardized_messages.append(std_msg)
         
-        logger.info(f"标准化后的消息数: {len(standardized_messages)}")
+        logger.info("标准化后的消息数: %d", len(standardized_messages))
         
         # 确保添加系统提示词，但不要覆盖现有历史
         system_prompt = kwargs.get('system_prompt', '')
@@ -272,11 +249,12 @@ class QianwenService(BaseLLMService):
         # 发送前验证消息完整性
         valid_messages = [msg for msg in standardized_messages if msg.get('content') and len(msg.get('content', '')) > 0]
         if len(valid_messages) < len(standardized_messages):
-            logger.warning(f"过滤掉了{len(standardized_messages) - len(valid_messages)}条空消息")
+            logger.warning("过滤掉了%d条空消息", len(standardized_messages) - len(valid_messages))
             standardized_messages = valid_messages
         
         # 在chat_completion方法的标准化消息后添加
-        logger.info(f"最终发送给LLM的完整消息列表: {json.dumps([{{'role': m.get('role'), 'content_preview': m.get('content', '')[:30] + '...' if m.get('content') else ''}} for m in standardized_messages], ensure_ascii=False)}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("最终发送给LLM的完整消息列表: %s", json.dumps([{'role': m.get('role'), 'content_preview': m.get('content', '')[:30] + '...' if m.get('content') else ''} for m in standardized_messages], ensure_ascii=False))
         
         # 调用原有实现
         return await self._chat_completion_impl(standardized_messages, **kwargs)
@@ -1,12 +1,40 @@
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, FrozenSet
+from collections import OrderedDict
 from app.models.entities.mongo_models import RoleReference
 import logging
 import re
 import json
 
+# 选择角色时每条消息、每个角色都会用到的正则，模块加载时编译一次
+_PRONOUN_RE = re.compile(r'(你|您|你们|汝|尔|阁下)')
+_FOLLOW_UP_RE = re.compile(r'^(为什么|怎么办|然后呢|还有呢|继续|详细说说|那么|所以).{0,10}$')
+_METADATA_RE = re.compile(r'<role_metadata>(.*?)</role_metadata>', re.DOTALL)
+_LEGACY_FIELD_RES = {
+    "expertise": re.compile(r'(专长|擅长|专业|领域)\s*[:：]\s*(.*?)(?:\n|$)'),
+    "keywords": re.compile(r'(关键词|特点|标签)\s*[:：]\s*(.*?)(?:\n|$)'),
+    "emotions": re.compile(r'(情绪|情感|态度)\s*[:：]\s*(.*?)(?:\n|$)'),
+}
+# 拆分专长/关键词字段为独立词条的分隔符（含JSON列表中的标点）
+_TERM_SPLIT_RE = re.compile(r'[\s,，、;；:：/|"\'\[\]{}()（）。]+')
+# 参与匹配的最短词条长度，过短的词条容易误匹配
+_MIN_TERM_LEN = 2
+
+
+def _split_terms(text: str) -> FrozenSet[str]:
+    """将字段文本拆分为小写词条集合"""
+    return frozenset(t for t in _TERM_SPLIT_RE.split(text.lower()) if len(t) >= _MIN_TERM_LEN)
+
+
 class RoleSelector:
     """角色选择器，用于选择最相关的角色进行回复"""
     
+    # 关键词快速选择要求领先第二名的最少词条数
+    TERM_MATCH_MARGIN = 2
+    # 角色词条缓存的最大条目数
+    ROLE_TERMS_CACHE_SIZE = 256
+    # 按系统提示词缓存的角色词条，跨实例共享
+    _role_terms_cache: "OrderedDict[str, FrozenSet[str]]" = OrderedDict()
+    
     def __init__(self, llm_service):
         self.llm_service = llm_service
         self.logger = logging.getLogger(__name__)
@@ -31,6 +59,13 @@ class RoleSelector:
                     self.logger.info(f"检测到对话连续性，沿用上一次的角色: {role.role_name}")
                     return role
         
+        # 消息明显命中某个角色的专长或关键词时直接选择，省去一次LLM调用
+        selected_role = self._select_by_terms(message, roles)
+        if selected_role:
+            self.logger.info(f"按关键词匹配选择角色: {selected_role.role_name} (ID: {selected_role.role_id})")
+            self.last_selected_role = selected_role
+            return selected_role
+        
         # 构建评估提示
         evaluation_prompt = self._build_evaluation_prompt(message, roles, chat_history)
         
@@ -66,13 +101,11 @@ class RoleSelector:
             return False
         
         # 检查消息中是否包含代词"你"、"您"等指代上一个角色的词
-        pronoun_pattern = r'(你|您|你们|汝|尔|阁下)'
-        if re.search(pronoun_pattern, message):
+        if _PRONOUN_RE.search(message):
             return True
             
         # 检查是否是简短的后续问题如"为什么"、"怎么办"、"还有呢"等
-        follow_up_pattern = r'^(为什么|怎么办|然后呢|还有呢|继续|详细说说|那么|所以).{0,10}$'
-        if re.search(follow_up_pattern, message):
+        if _FOLLOW_UP_RE.search(message):
             return True
             
         # 如果最近一次对话是与当前用户的，且时间间隔较短，增加连续性判断
@@ -80,6 +113,39 @@ class RoleSelector:
             
         return False
     
+    def _select_by_terms(self, message: str, roles: List[RoleReference]) -> Optional[RoleReference]:
+        """按消息中出现的角色专长/关键词词条数选择角色
+
+        只有得分最高的角色唯一且领先第二名至少 TERM_MATCH_MARGIN 个词条时才返回，否则返回None交由LLM判断。
+        """
+        text = message.lower()
+        best_role = None
+        best_score = 0
+        second_score = 0
+        for role in roles:
+            terms = self._role_terms(role.system_prompt or "")
+            score = sum(1 for term in terms if term in text)
+            if score > best_score:
+                best_role, best_score, second_score = role, score, best_score
+            elif score > second_score:
+                second_score = score
+        if best_score - second_score >= self.TERM_MATCH_MARGIN:
+            return best_role
+        return None
+    
+    def _role_terms(self, system_prompt: str) -> FrozenSet[str]:
+        """提取角色的专长和关键词词条，相同的系统提示词只解析一次"""
+        cache = RoleSelector._role_terms_cache
+        terms = cache.get(system_prompt)
+        if terms is not None:
+            cache.move_to_end(system_prompt)
+            return terms
+        terms = _split_terms(self._extract_expertise(system_prompt)) | _split_terms(self._extract_keywords(system_prompt))
+        cache[system_prompt] = terms
+        if len(cache) > self.ROLE_TERMS_CACHE_SIZE:
+            cache.popitem(last=False)
+        return terms
+    
     def _build_evaluation_prompt(self, message: str, roles: List[RoleReference], history=None) -> str:
         """构建评估提示"""
         # 提取每个角色的专长领域和关键词
@@ -150,8 +216,7 @@ class RoleSelector:
         """从system_prompt中提取元数据"""
         try:
             # 匹配<role_metadata>标签中的JSON
-            metadata_match = re.search(r'<role_metadata>(.*?)</role_metadata>', 
-                                      system_prompt, re.DOTALL)
+            metadata_match = _METADATA_RE.search(system_prompt)
             
             if metadata_match:
                 metadata = json.loads(metadata_match.group(1))
@@ -177,20 +242,11 @@ class RoleSelector:
 
     def _legacy_extract(self, system_prompt: str, field: str) -> str:
         """旧式提取方法，从system_prompt中简单提取字段信息"""
-        # 根据不同字段使用不同的提取逻辑
-        if field == "expertise":
-            # 查找"专长"、"擅长"、"专业"等相关词后的内容
-            match = re.search(r'(专长|擅长|专业|领域)\s*[:：]\s*(.*?)(?:\n|$)', system_prompt)
-            if match:
-                return match.group(2).strip()
-        elif field == "keywords":
-            # 查找"关键词"、"特点"等相关词后的内容
-            match = re.search(r'(关键词|特点|标签)\s*[:：]\s*(.*?)(?:\n|$)', system_prompt)
-            if match:
-                return match.group(2).strip()
-        elif field == "emotions":
-            # 查找"情绪"、"情感"等相关词后的内容
-            match = re.search(r'(情绪|情感|态度)\s*[:：]\s*(.*?)(?:\n|$)', system_prompt)
+        # 根据不同字段使用不同的提取逻辑：
+        # expertise 查找"专长"、"擅长"等，keywords 查找"关键词"、"特点"等，emotions 查找"情绪"、"情感"等
+        pattern = _LEGACY_FIELD_RES.get(field)
+        if pattern:
+            match = pattern.search(system_prompt)
             if match:
                 return match.group(2).strip()
         
@@ -3,7 +3,9 @@
 import os
 import asyncio
 import logging
-from typing import Dict, Any, List, Optional, Union
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Union
 from datetime import datetime
 import json
 import uuid
@@ -38,6 +40,16 @@ assistant_fields = {
 class MemoryService:
     """记忆服务，负责管理会话历史与构建对话上下文"""
     
+    # 最近消息缓存的最大会话数，以及所有会话缓存的消息总条数上限
+    RECENT_MESSAGES_CACHE_SIZE = 1024
+    RECENT_MESSAGES_CACHE_MAX_MESSAGES = 20000
+    # 按会话缓存的最近消息，跨实例共享: session_id -> (缓存时间, 消息数量上限, Redis列表长度, 最近消息)
+    _recent_messages_cache: "OrderedDict[str, Tuple[float, int, int, List[Dict[str, Any]]]]" = OrderedDict()
+    # 缓存中的消息总条数
+    _recent_messages_total = 0
+    # MongoDB备份任务的强引用，防止任务完成前被回收
+    _backup_tasks: set = set()
+    
     def __init__(
         self, 
         redis_memory: Optional[RedisMemory] = None, 
@@ -68,7 +80,7 @@ class MemoryService:
             )
             
             # 异步备份到MongoDB
-            backup_task = asyncio.create_task(
+            self._backup_in_background(
                 self.mongo_backup.backup_message(
                     session_id=session_id, 
                     role="user", 
@@ -95,7 +107,7 @@ class MemoryService:
             )
             
             # 异步备份到MongoDB，同样传递所有参数
-            backup_task = asyncio.create_task(
+            self._backup_in_background(
                 self.mongo_backup.backup_message(
                     session_id=session_id, 
                     role="assistant", 
@@ -109,6 +121,13 @@ class MemoryService:
         except Exception as e:
             logger.error(f"添加助手消息到记忆失败: {e}")
     
+    @classmethod
+    def _backup_in_background(cls, coro) -> None:
+        """在后台执行MongoDB备份，并保持任务引用直到完成"""
+        task = asyncio.create_task(coro)
+        cls._backup_tasks.add(task)
+        task.add_done_callback(cls._backup_tasks.discard)
+    
     async def build_message_history(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
         """构建消息历史用于LLM上下文
         
@@ -127,11 +146,8 @@ class MemoryService:
         actual_limit = limit or self.max_context_length
         logger.info("构建消息历史", extra={"data": {"limit": actual_limit}})
         
-        # 首先从Redis获取最近消息
-        messages = await self.redis_memory.get_messages(session_id, actual_limit)
-        
-        # 检查消息时间顺序
-        logger.info(f"消息时间顺序检查: {[msg.get('timestamp', 'no-timestamp') for msg in messages[:5]]}")
+        # 首先从Redis获取最近消息，只读取上次构建之后新增的部分
+        messages = await self._get_recent_messages(session_id, actual_limit)
         
         # 格式化消息以适应LLM API格式
         formatted_messages = []
@@ -141,34 +157,98 @@ class MemoryService:
             elif msg["role"] == "assistant":
                 formatted_messages.append({"role": "assistant", "content": msg["content"]})
         
-        logger.info(f"为AI请求构建上下文: 获取到{len(messages)}条消息")
+        logger.debug("history_stats", extra={"data": {
+            "session_id": session_id,
+            "raw_messages": len(messages),
+            "history_len": len(formatted_messages)
+        }})
+        # 以下诊断日志需要遍历全部历史，仅在DEBUG级别启用时计算
+        if logger.isEnabledFor(logging.DEBUG):
+            self._log_history_summary(messages, formatted_messages)
+        
+        return formatted_messages
+    
+    def _log_history_summary(self, messages: List[Dict[str, Any]], formatted_messages: List[Dict[str, str]]) -> None:
+        """记录消息历史的诊断信息"""
+        # 检查消息时间顺序
+        logger.debug("消息时间顺序检查: %s", [msg.get('timestamp', 'no-timestamp') for msg in messages[:5]])
+        logger.debug("为AI请求构建上下文: 获取到%d条消息", len(messages))
         # 记录消息摘要
         for i, msg in enumerate(messages[:3]):
             preview = msg["content"][:30] + ("..." if len(msg["content"]) > 30 else "")
-            logger.info("消息详情", extra={"data": {"index": i, "role": msg['role'], "preview": preview, "length": len(msg['content'])}})
+            logger.debug("消息详情", extra={"data": {"index": i, "role": msg['role'], "preview": preview, "length": len(msg['content'])}})
         
-        logger.debug(f"为会话构建了{len(formatted_messages)}条消息历史: session={session_id}")
-        logger.info(f"格式化后的消息历史总数: {len(formatted_messages)}")
+        logger.debug("格式化后的消息历史总数: %d", len(formatted_messages))
+        if not formatted_messages:
+            return
         
-        if formatted_messages:
-            logger.info(f"第一条消息: {formatted_messages[0]}")
-            logger.info(f"最后一条消息: {formatted_messages[-1]}")
-            # 打印完整内容长度统计
-            logger.info(f"完整历史长度统计: {[len(msg['content']) for msg in formatted_messages]}")
-            logger.info(f"消息历史总字符数: {sum(len(msg['content']) for msg in formatted_messages)}")
-            
-            # 转换成更易读的日志格式，显示每条消息的概览
-            preview_messages = []
-            for i, msg in enumerate(formatted_messages):
-                preview_messages.append({
-                    "index": i,
-                    "role": msg["role"],
-                    "content_length": len(msg["content"]),
-                    "preview": msg["content"][:50] + ("..." if len(msg["content"]) > 50 else "")
-                })
-            logger.info(f"消息历史预览: {json.dumps(preview_messages, ensure_ascii=False)}")
+        logger.debug("第一条消息: %s", formatted_messages[0])
+        logger.debug("最后一条消息: %s", formatted_messages[-1])
+        # 打印完整内容长度统计，各消息长度只计算一次
+        lengths = [len(msg['content']) for msg in formatted_messages]
+        logger.debug("完整历史长度统计: %s", lengths)
+        logger.debug("消息历史总字符数: %d", sum(lengths))
         
-        return formatted_messages
+        # 转换成更易读的日志格式，显示每条消息的概览
+        preview_messages = []
+        for i, (msg, length) in enumerate(zip(formatted_messages, lengths)):
+            preview_messages.append({
+                "index": i,
+                "role": msg["role"],
+                "content_length": length,
+                "preview": msg["content"][:50] + ("..." if length > 50 else "")
+            })
+        logger.debug("消息历史预览: %s", json.dumps(preview_messages, ensure_ascii=False))
+    
+    async def _get_recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        """获取最近limit条消息
+
+        Redis中的消息列表只会追加，缓存上次读取到的列表长度，之后只读取新增的消息。
+        使用缓存前先核对Redis中缓存末条消息所在位置的消息是否仍是同一条：列表可能已被其他进程
+        清除后重新增长，仅比较长度无法发现。核对失败、缓存超过message_ttl或数量上限变化时重新完整读取。
+        """
+        now = time.monotonic()
+        cached = self._recent_messages_cache.get(session_id)
+        messages = None
+        if (cached is not None and cached[1] == limit and cached[3]
+                and now - cached[0] < self.message_ttl):
+            _, _, cached_count, cached_messages = cached
+            # 长度与校验消息在同一次Redis往返中读取
+            count, marker = await self.redis_memory.get_count_and_message(session_id, cached_count - 1)
+            if count >= cached_count and marker == cached_messages[-1]:
+                if count == cached_count:
+                    messages = cached_messages
+                else:
+                    start = max(cached_count, count - limit)
+                    new_messages = await self.redis_memory.get_messages_range(session_id, start, count - 1)
+                    messages = (cached_messages + new_messages)[-limit:]
+        else:
+            count = await self.redis_memory.get_message_count(session_id)
+        if messages is None:
+            start = max(0, count - limit)
+            messages = await self.redis_memory.get_messages_range(session_id, start, count - 1) if count else []
+        
+        self._cache_recent_messages(session_id, (now, limit, count, messages))
+        return list(messages)
+    
+    @classmethod
+    def _cache_recent_messages(cls, session_id: str, entry: Tuple[float, int, int, List[Dict[str, Any]]]) -> None:
+        """写入最近消息缓存，超过会话数或消息总条数上限时淘汰最久未用的会话"""
+        cls._drop_recent_messages(session_id)
+        cls._recent_messages_cache[session_id] = entry
+        cls._recent_messages_total += len(entry[3])
+        while cls._recent_messages_cache and (
+                len(cls._recent_messages_cache) > cls.RECENT_MESSAGES_CACHE_SIZE
+                or cls._recent_messages_total > cls.RECENT_MESSAGES_CACHE_MAX_MESSAGES):
+            _, evicted = cls._recent_messages_cache.popitem(last=False)
+            cls._recent_messages_total -= len(evicted[3])
+    
+    @classmethod
+    def _drop_recent_messages(cls, session_id: str) -> None:
+        """移除会话的最近消息缓存"""
+        evicted = cls._recent_messages_cache.pop(session_id, None)
+        if evicted is not None:
+            cls._recent_messages_total -= len(evicted[3])
     
     async def get_full_history(self, session_id: str, limit: int = 100) -> List[Dict[str, Any]]:
         """获取完整聊天历史（MongoDB存档）
@@ -200,5 +280,6 @@ class MemoryService:
             return False
             
         result = await self.redis_memory.clear_messages(session_id)
+        self._drop_recent_messages(session_id)
         logger.info(f"已清除会话的Redis历史记录: session={session_id}, 结果={result}")
         return result
@@ -65,10 +65,8 @@ class RedisMemory(BaseMemory):
                 
             # 序列化并存储
             serialized = json.dumps(message)
-            await self.redis_service.rpush(key, serialized)
-            
-            # 设置过期时间
-            await self.redis_service.expire(key, self.message_ttl)
+            # 写入并设置过期时间，合并为一次Redis往返
+            await self.redis_service.rpush_expire(key, self.message_ttl, serialized)
             logger.debug(f"消息已添加到Redis: {key}, TTL={self.message_ttl}")
             return True
         except Exception as e:
@@ -100,15 +98,7 @@ class RedisMemory(BaseMemory):
             
             # 获取消息
             raw_messages = await self.redis_service.lrange(key, start, end)
-            messages = []
-            
-            # 反序列化
-            for raw in raw_messages:
-                try:
-                    message = json.loads(raw)
-                    messages.append(message)
-                except json.JSONDecodeError:
-                    logger.warning(f"无法解析Redis消息: {raw}")
+            messages = self._deserialize_messages(raw_messages)
             
             logger.debug(f"从Redis获取了{len(messages)}条消息，session={session_id}")
             return messages
@@ -116,6 +106,68 @@ class RedisMemory(BaseMemory):
             logger.error(f"从Redis获取消息失败: {str(e)}")
             return []
             
+    async def get_message_count(self, session_id: str) -> int:
+        """获取会话在Redis中的消息总数
+        
+        Args:
+            session_id: 会话ID
+            
+        Returns:
+            int: 消息数量，出错时返回0
+        """
+        try:
+            return await self.redis_service.llen(self._get_session_key(session_id))
+        except Exception as e:
+            logger.error(f"获取Redis消息数量失败: {str(e)}")
+            return 0
+    
+    async def get_count_and_message(self, session_id: str, index: int) -> tuple:
+        """获取会话消息总数及指定索引处的消息，用于校验本地缓存的消息是否仍在Redis中
+        
+        Args:
+            session_id: 会话ID
+            index: 消息索引
+            
+        Returns:
+            tuple: (消息数量, 消息)，消息不存在或无法解析时为None
+        """
+        length, raw = await self.redis_service.llen_lindex(self._get_session_key(session_id), index)
+        if raw is None:
+            return length, None
+        try:
+            return length, json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"无法解析Redis消息: {raw}")
+            return length, None
+    
+    async def get_messages_range(self, session_id: str, start: int, end: int) -> List[Dict[str, Any]]:
+        """按列表索引获取消息，用于只读取新增的消息
+        
+        Args:
+            session_id: 会话ID
+            start: 起始索引
+            end: 结束索引（包含）
+            
+        Returns:
+            List[Dict[str, Any]]: 消息列表
+        """
+        try:
+            raw_messages = await self.redis_service.lrange(self._get_session_key(session_id), start, end)
+            return self._deserialize_messages(raw_messages)
+        except Exception as e:
+            logger.error(f"从Redis获取消息失败: {str(e)}")
+            return []
+    
+    def _deserialize_messages(self, raw_messages: List[Any]) -> List[Dict[str, Any]]:
+        """反序列化Redis中的消息，跳过无法解析的条目"""
+        messages = []
+        for raw in raw_messages:
+            try:
+                messages.append(json.loads(raw))
+            except json.JSONDecodeError:
+                logger.warning(f"无法解析Redis消息: {raw}")
+        return messages
+            
     async def clear_messages(self, session_id: str) -> bool:
         """清除历史消息
         
@@ -2,7 +2,7 @@ from typing import Dict, Any, List, Optional, AsyncGenerator
 import logging
 import aiohttp
 import os
-import json
+import orjson
 import asyncio
 
 class RAGService:
@@ -45,7 +45,7 @@ class RAGService:
     async def retrieve_stream(self, query: str) -> AsyncGenerator[Dict[str, Any], None]:
         """流式检索方法，使用RAGFlow接口返回SSE流"""
         url = f"{self.api_url}/api/v1/chats_openai/{self.chat_id}/chat/completions"
-        print(f"RAGFlow接口 url: {url}")
+        self.logger.debug("RAGFlow接口 url: %s", url)
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -68,10 +68,9 @@ class RAGService:
                         raise Exception(f"RAGFlow请求失败: {response.status} - {error_text}")
                     
                     # 处理SSE流
-                    buffer = ""
                     async for line in response.content:
                         line = line.decode('utf-8').strip()
-                        print(f"收到line: {line}")
+                        self.logger.debug("收到line: %s", line)
                         if not line or not line.startswith('data:'):
                             continue
                             
@@ -80,7 +79,7 @@ class RAGService:
                             break
                             
                         try:
-                            data = json.loads(data_str)
+                            data = orjson.loads(data_str)
                             # 提取内容 - 尝试多种可能的路径
                             content = None
                             
@@ -96,13 +95,12 @@ class RAGService:
                                 content = data['content']
                                 
                             if content:
-                                buffer += content
+                                # 只产出增量内容，需要完整内容的调用方自行拼接
                                 yield {
                                     "event": "rag_thinking",
-                                    "content": content,
-                                    "full_content": buffer
+                                    "content": content
                                 }
-                        except json.JSONDecodeError:
+                        except orjson.JSONDecodeError:
                             continue
                             
         except Exception as e:
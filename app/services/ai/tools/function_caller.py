@@ -1,5 +1,7 @@
-from typing import Dict, Any
+from typing import Dict, Any, Awaitable, Callable, Optional, Union
 from pydantic import BaseModel, ValidationError
+import asyncio
+import inspect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,6 +14,10 @@ class FunctionDefinition(BaseModel):
 
 class FunctionCaller:
     """实现Function Calling功能，包含参数校验和日志记录"""
+    
+    # 进行中的RAG检索，按增强查询共享结果: 增强查询 -> 检索结果Future
+    _inflight_rag: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+    
     def __init__(self):
         self.functions = self._initialize_functions()
     
@@ -67,21 +73,21 @@ class FunctionCaller:
     async def call_function(self, function_name: str, **kwargs) -> Dict[str, Any]:
         """调用指定函数，包含参数校验和日志"""
         if function_name not in self.functions:
-            logger.error(f"Function {function_name} not found")
+            logger.error("Function %s not found", function_name)
             raise ValueError(f"Function {function_name} not found")
         func_def = self.functions[function_name]
         # 参数校验
         required = func_def.parameters.get("required", [])
         for req in required:
             if req not in kwargs:
-                logger.error(f"参数 {req} 缺失")
+                logger.error("参数 %s 缺失", req)
                 raise ValueError(f"参数 {req} 缺失")
-        logger.info(f"调用函数: {function_name}, 参数: {kwargs}")
+        logger.info("调用函数: %s, 参数: %s", function_name, kwargs)
         try:
             method = getattr(self, function_name)
             return await method(**kwargs)
         except Exception as e:
-            logger.exception(f"调用函数 {function_name} 失败: {e}")
+            logger.exception("调用函数 %s 失败: %s", function_name, e)
             raise
 
     async def classify_content(self, text: str, context: str = "") -> Dict[str, Any]:
@@ -114,12 +120,16 @@ class FunctionCaller:
             }
         # ... 其他分类规则
         
-        logger.info(f"内容分类结果: {classification}")
+        logger.info("内容分类结果: %s", classification)
         return classification
 
-    async def trigger_rag(self, query: str, character_filter: str = None, event_filter: str = None, faction_filter: str = None) -> Dict[str, Any]:
-        """明日方舟剧情知识库检索触发器 - 由大模型主动调用"""
-        logger.info(f"触发 trigger_rag 函数 - 查询: '{query}'")
+    async def trigger_rag(self, query: str, character_filter: str = None, event_filter: str = None, faction_filter: str = None, on_chunk: Optional[Callable[[str], Union[None, Awaitable[None]]]] = None) -> Dict[str, Any]:
+        """明日方舟剧情知识库检索触发器 - 由大模型主动调用
+
+        on_chunk: 可选回调，每收到一个检索块立即调用，便于调用方边检索边推送；
+            回调返回可等待对象时会等待其完成，调用方可借此对检索施加背压
+        """
+        logger.info("触发 trigger_rag 函数 - 查询: '%s'", query)
         
         # 构建增强查询
         enhanced_query = query
@@ -135,24 +145,54 @@ class FunctionCaller:
         if filters:
             enhanced_query = f"{query} {' '.join(filters)}"
         
+        # 相同查询的检索正在进行时直接等待其结果，不重复请求RAG服务；
+        # 等待方不会收到检索块，由调用方按最终结果推送
+        inflight = FunctionCaller._inflight_rag.get(enhanced_query)
+        if inflight is not None:
+            logger.info("相同查询的RAG检索正在进行，等待其结果: '%s'", enhanced_query)
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # 发起检索的请求已取消（如客户端断开），改为自行检索
+                logger.info("共享的RAG检索已取消，重新检索")
+        
+        future = asyncio.get_running_loop().create_future()
+        FunctionCaller._inflight_rag[enhanced_query] = future
+        try:
+            result = await self._retrieve_rag(query, enhanced_query, character_filter, event_filter, faction_filter, on_chunk)
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():
+                future.cancel()
+            if FunctionCaller._inflight_rag.get(enhanced_query) is future:
+                del FunctionCaller._inflight_rag[enhanced_query]
+    
+    async def _retrieve_rag(self, query: str, enhanced_query: str, character_filter: Optional[str], event_filter: Optional[str], faction_filter: Optional[str], on_chunk: Optional[Callable[[str], Union[None, Awaitable[None]]]]) -> Dict[str, Any]:
+        """执行RAG检索并整理结果，检索失败时返回retrieved=False的结果"""
         # 调用实际的RAG服务进行检索
         try:
             from app.services.ai.rag.rag_service import RAGService
             rag_service = RAGService()
             
-            # 执行知识检索并累积结果
-            full_content = ""
-            chunks = []  # 保存所有分块，用于调试
+            # 执行知识检索，分块保存，结束后一次性拼接
+            chunks = []
             
             # 直接获取流式结果
             async for rag_chunk in rag_service.retrieve_stream(enhanced_query):
                 content = rag_chunk.get("content", "")
                 if content:
                     chunks.append(content)
-                    full_content += content
-                    logger.debug(f"RAG检索块长度: {len(content)}, 累积长度: {len(full_content)}")
+                    if on_chunk:
+                        result = on_chunk(content)
+                        if inspect.isawaitable(result):
+                            await result
+                    logger.debug("RAG检索块长度: %d, 块序号: %d", len(content), len(chunks))
+            full_content = "".join(chunks)
             
-            logger.info(f"RAG检索完成, 总块数: {len(chunks)}, 总内容长度: {len(full_content)}")
+            logger.info("RAG检索完成, 总块数: %d, 总内容长度: %d", len(chunks), len(full_content))
             
             # 处理检索结果
             if full_content:
@@ -170,14 +210,14 @@ class FunctionCaller:
                     "data_length": len(full_content)
                 }
             else:
-                logger.warning(f"RAG检索未返回有效内容，查询:{enhanced_query}")
+                logger.warning("RAG检索未返回有效内容，查询:%s", enhanced_query)
                 return {
                     "retrieved": False,
                     "query": enhanced_query,
                     "reason": "未在明日方舟剧情知识库中找到相关内容"
                 }
         except Exception as e:
-            logger.error(f"明日方舟剧情RAG检索失败: {str(e)}")
+            logger.error("明日方舟剧情RAG检索失败: %s", e)
             return {
                 "retrieved": False,
                 "query": enhanced_query,
@@ -1,17 +1,21 @@
-import uuid
 import os
-from typing import Dict, Any, Optional, List, AsyncGenerator
+from typing import Dict, Any, Optional, List, AsyncGenerator, Tuple
 from datetime import datetime
 from langchain_core.exceptions import OutputParserException
-import json
 import logging
 import re
 import asyncio
+import functools
+import math
+import hashlib
+import json
+import orjson
 
-from .ai.llm.llm_factory import LLMFactory
+from .ai.llm.llm_factory import llm_factory
 from .ai.prompt.prompt_service import PromptService
 from .ai.response.response_formatter import ResponseFormatter
 from .session_service import SessionService
+from app.services.ai.llm.base_llm_service import scan_tags
 from app.services.ai.llm.role_selector import RoleSelector
 from app.services.formatters import StreamFormatter, SSEFormatter
 from app.models.entities.mongo_models import Session
@@ -21,17 +25,380 @@ from app.services.storage.session_repository import SessionRepository
 from app.services.storage.redis_service import RedisService
 from app.models.entities.mongo_models import Role
 from app.services.storage.mongo_repository import MongoRepository
-from app.services.ai.filter.content_filter import ContentFilter
-from app.services.ai.rag.rag_router import RAGRouter
-from app.services.ai.rag.rag_service import RAGService
-from app.services.ai.tools.tool_router import ContentToolRouter
 from app.services.ai.tools.function_caller import FunctionCaller
 from app.services.ai.memory.memory_service import MemoryService
 from app.utils.logging import logger, AILogger, LogContext, merge_extra_data
 
+# 默认模型类型，运行期间不会变化，导入时读取一次
+_DEFAULT_MODEL_TYPE = os.getenv("DEFAULT_MODEL_TYPE", "deepseek")
+
+# 情绪『...』与动作【...】标记，一次扫描同时匹配两种标记，交给 scan_tags 增量扫描
+# 用排除结束符的字符类代替惰性 .*?，引擎无需在每个字符处回溯尝试结束符
+_TAG_RE = re.compile(r'『(?P<emotion>[^』\n]*)』|【(?P<action>[^】\n]*)】')
+
+
+# 以JSON对象开头的回复可能是逐token输出的function_call，边接收边解析，
+# 拿到完整的name和arguments即可执行，无需等待整个对象闭合
+_FUNCTION_CALL_KEY_RE = re.compile(r'"function_call"\s*:\s*')
+_FUNCTION_CALL_FIELD_RE = re.compile(r'"(name|arguments)"\s*:\s*')
+# 超过该长度仍未出现function_call键时视为普通内容
+_FUNCTION_CALL_KEY_WINDOW = 64
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _decode_json_prefix(text: str, pos: int) -> Tuple[Any, int]:
+    """解析text中pos处的JSON值，返回 (值, 结束位置)；值尚未完整时结束位置为-1"""
+    try:
+        return _JSON_DECODER.raw_decode(text, pos)
+    except ValueError:
+        return None, -1
+
+
+def _scan_function_call(text: str) -> Tuple[str, Any]:
+    """检查以"{"开头、仍在接收中的回复是否为function_call
+
+    返回 ('call', function_call数据)、('pending', None) 需要更多内容，
+    或 ('text', None) 不是function_call，应作为普通内容输出。
+    """
+    start = len(text) - len(text.lstrip())
+    if not text.startswith('{', start):
+        return 'text', None
+    whole, end = _decode_json_prefix(text, start)
+    if end >= 0:
+        # function_call须为对象，否则无法取得name和arguments，按普通内容输出
+        if isinstance(whole, dict) and isinstance(whole.get('function_call'), dict):
+            return 'call', whole['function_call']
+        return 'text', None
+    key = _FUNCTION_CALL_KEY_RE.search(text, start)
+    if key is None:
+        return ('text', None) if len(text) - start > _FUNCTION_CALL_KEY_WINDOW else ('pending', None)
+    if not text.startswith('{', key.end()):
+        return 'pending', None
+    # 依次解析function_call对象中的字段，跳过已解析的值，避免误匹配参数内部的同名键
+    fields = {}
+    pos = key.end() + 1
+    while 'name' not in fields or 'arguments' not in fields:
+        field = _FUNCTION_CALL_FIELD_RE.search(text, pos)
+        if field is None:
+            break
+        value, pos = _decode_json_prefix(text, field.end())
+        if pos < 0:
+            break
+        fields.setdefault(field.group(1), value)
+    if isinstance(fields.get('name'), str) and 'arguments' in fields:
+        return 'call', fields
+    return 'pending', None
+
+
+# 每个chunk返回截至目前完整内容的模型类型，其余模型的chunk均为增量
+_CUMULATIVE_MODEL_TYPES = frozenset(('qianwen',))
+
+
+def _is_incremental(model_type: str) -> bool:
+    """判断模型的流式chunk是否为增量内容，需要手动累积"""
+    return model_type not in _CUMULATIVE_MODEL_TYPES
+
+
+# 流式批量推送：累积 N 个 chunk 或距上次推送超过 T 毫秒后合并为一个SSE事件
+# 批量大小从 SSE_MIN_BATCH_SIZE 开始，每次推送后按 SSE_BATCH_GROWTH 倍增长至 SSE_BATCH_SIZE，
+# 回复开头尽快推送，之后逐步合并更多chunk
+_SSE_BATCH_SIZE = max(1, int(os.getenv("SSE_BATCH_SIZE", 8)))
+_SSE_MIN_BATCH_SIZE = min(_SSE_BATCH_SIZE, max(1, int(os.getenv("SSE_MIN_BATCH_SIZE", 1))))
+_SSE_BATCH_GROWTH = max(1.0, float(os.getenv("SSE_BATCH_GROWTH", 2)))
+_SSE_BATCH_INTERVAL = max(0, int(os.getenv("SSE_BATCH_MS", 25))) / 1000
+# 等待上游 chunk 超时时产出的刷新标记
+_FLUSH_TICK = object()
+
+# 句子模式：在句末标点处合并推送，便于下游TTS等按句处理；句子过长时累积到上限也会推送
+_SENTENCE_END_CHARS = '。！？!?…'
+_SENTENCE_CLOSING_CHARS = '」”"’）)'
+_SENTENCE_MAX_CHUNKS = 80
+# 以句点结尾但不是句末的常见英文缩写
+_ABBREVIATIONS = frozenset(('mr.', 'mrs.', 'ms.', 'dr.', 'st.', 'vs.', 'etc.', 'e.g.', 'i.e.'))
+# 候选句末：连续的句末标点（含句点）及其后的右引号、右括号
+_SENTENCE_END_RE = re.compile('[' + re.escape(_SENTENCE_END_CHARS) + r'.]+[' + re.escape(_SENTENCE_CLOSING_CHARS) + ']*')
+_SENTENCE_MARK_RE = re.compile('[' + re.escape(_SENTENCE_END_CHARS + _SENTENCE_CLOSING_CHARS) + '.]')
+
+
+def _is_sentence_boundary(text: str) -> bool:
+    """判断文本是否以完整句子结尾"""
+    stripped = text.rstrip().rstrip(_SENTENCE_CLOSING_CHARS)
+    if not stripped:
+        return False
+    last = stripped[-1]
+    if last in _SENTENCE_END_CHARS:
+        return True
+    if last != '.':
+        return False
+    # 数字后的句点可能是小数或版本号（如 v2.0），缩写后的句点也不是句末
+    if len(stripped) >= 2 and stripped[-2].isdigit():
+        return False
+    return stripped.rsplit(None, 1)[-1].lower() not in _ABBREVIATIONS
+
+
+def _last_sentence_end(text: str, start: int = 0) -> int:
+    """返回text中位于start之后的最后一个句末位置（含其后的右引号、右括号），没有时返回-1
+
+    句末标点可以在start之前，如已推送"。"后单独到达的"」"，此时返回"」"之后的位置。
+    """
+    end = -1
+    for match in _SENTENCE_END_RE.finditer(text, max(0, start - 1)):
+        # 判断缩写和小数只需要句末前的一小段内容
+        if match.end() > start and _is_sentence_boundary(text[max(0, match.start() - 8):match.end()]):
+            end = match.end()
+    return end
+
+
+async def _with_flush_deadline(stream, interval: float):
+    """包装异步流，等待下一个chunk超过interval秒时产出_FLUSH_TICK
+
+    等待中的chunk不会被取消，超时后继续等待同一个chunk。
+    包装流被关闭时（如客户端断开）同时关闭上游流，停止继续消耗模型输出。
+    """
+    iterator = stream.__aiter__()
+    pending = None
+    try:
+        if interval <= 0:
+            async for chunk in iterator:
+                yield chunk
+            return
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield _FLUSH_TICK
+                continue
+            pending = None
+            try:
+                chunk = done.pop().result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            # 等待取消生效后上游流才能被关闭
+            await asyncio.wait({pending})
+        aclose = getattr(iterator, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+# 每种模型同时进行的流式调用上限，按服务商限流配置；默认0表示不限制
+_LLM_MAX_CONCURRENCY = max(0, int(os.getenv("LLM_MAX_CONCURRENCY", 0)))
+# 达到上限时排队等待的最长秒数，超时向客户端返回错误事件；0表示一直等待
+_LLM_QUEUE_TIMEOUT = max(0.0, float(os.getenv("LLM_QUEUE_TIMEOUT", 30)))
+
+
+class _LLMBusyError(Exception):
+    """排队等待模型并发名额超时"""
+
+
+async def _bounded_stream(stream, semaphore: asyncio.Semaphore, model_type: str):
+    """在持有信号量期间迭代上游流，流结束或被关闭时释放
+
+    并发已满时记录排队日志，等待超过 _LLM_QUEUE_TIMEOUT 秒抛出 _LLMBusyError。
+    """
+    if semaphore.locked():
+        logger.info("模型 %s 并发调用已达上限 %d，排队等待", model_type, _LLM_MAX_CONCURRENCY)
+    try:
+        await asyncio.wait_for(semaphore.acquire(), _LLM_QUEUE_TIMEOUT or None)
+    except asyncio.TimeoutError:
+        logger.warning("模型 %s 排队等待超过 %g 秒，放弃本次调用", model_type, _LLM_QUEUE_TIMEOUT)
+        raise _LLMBusyError(model_type) from None
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        semaphore.release()
+
+
+class _PrefetchedStream:
+    """在后台任务中提前消费上游异步流
+
+    创建后立即开始迭代上游（即发起模型请求），调用方在此期间可以先推送其他事件，
+    开始读取时已缓冲的chunk直接取出。队列有界，调用方读取较慢时后台任务等待。
+    """
+    
+    __slots__ = ('_stream', '_queue', '_task', '_finished')
+    
+    def __init__(self, stream, maxsize: int):
+        self._stream = stream
+        self._queue = asyncio.Queue(maxsize)
+        self._finished = False
+        self._task = asyncio.ensure_future(self._pump())
+    
+    async def _pump(self) -> None:
+        try:
+            async for chunk in self._stream:
+                await self._queue.put((True, chunk))
+        except Exception as e:
+            await self._queue.put((False, e))
+            return
+        await self._queue.put((False, None))
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+        ok, item = await self._queue.get()
+        if ok:
+            return item
+        self._finished = True
+        if item is not None:
+            raise item
+        raise StopAsyncIteration
+    
+    async def aclose(self) -> None:
+        """停止后台任务并关闭上游流，可重复调用"""
+        self._finished = True
+        if not self._task.done():
+            self._task.cancel()
+            await asyncio.wait({self._task})
+        aclose = getattr(self._stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+# 融入提示词的RAG内容最大字符数，0表示不限制；检索结果过长时截断，控制输入token数
+_RAG_PROMPT_MAX_CHARS = max(0, int(os.getenv("RAG_PROMPT_MAX_CHARS", 2000)))
+
+# 明日方舟相关关键词，编译为单个正则，一次扫描即可判断
+_ARKNIGHTS_KEYWORDS_RE = re.compile(r'明日方舟|罗德岛|阿米娅|源石|整合运动|干员')
+
+# 角色未定义情绪列表时使用的默认8种情绪
+_DEFAULT_EMOTIONS = ("信任", "喜悦", "期待", "悲伤", "恐惧", "惊讶", "愤怒", "厌恶")
+
+
+@functools.lru_cache(maxsize=256)
+def _build_emotion_constraint(valid_emotions: Tuple[str, ...]) -> str:
+    """生成情绪约束提示，相同的情绪列表跨会话只生成一次"""
+    if not valid_emotions:
+        return ""
+    return f"""
+请注意：回复时请严格使用以下{len(valid_emotions)}种情绪之一：
+{', '.join(valid_emotions)}
+情绪格式为『情绪』，例如『信任』、『悲伤』等。
+"""
+
+
+# 内容固定的事件帧，导入时编码一次
+_THINKING_COMPLETED_FRAME = SSEFormatter.static_frame({
+    'event': 'thinking_completed',
+    'message': '思考完成，正在生成回复...'
+})
+_COMPLETION_FRAME = SSEFormatter.static_frame({"event": "completion"})
+_STREAM_ERROR_FRAME = SSEFormatter.static_frame({"event": "error", "content": "处理消息时出错，请刷新页面重试"})
+_SESSION_NOT_FOUND_FRAME = SSEFormatter.static_frame({'event': 'error', 'message': '会话不存在'})
+_CONTENT_VIOLATION_FRAME = SSEFormatter.static_frame({'event': 'error', 'message': '内容违反规定'})
+_RAG_COMPLETED_FRAME = SSEFormatter.static_frame({
+    'event': 'rag_thinking_completed',
+    'message': '知识库检索完成'
+})
+_LLM_BUSY_FRAME = SSEFormatter.static_frame({'event': 'error', 'message': '当前请求较多，请稍后重试'})
+_FUNCTION_NAME_MISSING_FRAME = SSEFormatter.static_frame({
+    'event': 'function_result', 'name': None, 'status': 'error', 'error': "Function call missing 'name'."
+})
+
+# 首轮回复缓存的有效期（秒），0表示不启用
+# 系统提示词包含当前时间，缓存键按小时区分；默认关闭，避免相同问候总得到同一回复
+_REPLY_CACHE_TTL = max(0, int(os.getenv("REPLY_CACHE_TTL", 0)))
+
+
+async def _replay_reply(reply: str):
+    """以单个字符串chunk的流形式回放缓存的回复，复用正常的推送路径"""
+    yield reply
+
+
+class _StreamState:
+    """单次流式回复的累积状态
+
+    回复内容以增量片段列表保存，只在需要完整文本时才拼接，避免逐chunk字符串拼接的平方级复制。
+    """
+    
+    __slots__ = ('parts', 'length', 'sent_parts', '_joined', '_joined_count', 'tag_pending', 'scan_pos',
+                 'sentence_mode', 'pending_chunks', 'batch_size', 'last_flush', 'last_emotion', 'last_action', 'accum_mode', 'function_called', 'role_name', 'frame_fields', 'frame_template')
+    
+    def __init__(self, now: float, selected_role=None, sentence_mode: bool = False):
+        self.parts: List[str] = []  # 回复内容的增量片段
+        self.length = 0  # 已累积的字符数
+        self.sent_parts = 0  # 已发送给客户端的片段数，之后只推送增量
+        self._joined = ""
+        self._joined_count = 0
+        self.tag_pending = False  # 上次扫描后是否出现过标记结束符，只有此时才可能有新的完整标记
+        self.scan_pos = 0  # 已扫描到的位置，之后只扫描该位置之后的内容
+        self.sentence_mode = sentence_mode  # 是否按句推送
+        self.pending_chunks = 0  # 自上次推送以来累积的chunk数
+        self.batch_size = _SSE_MIN_BATCH_SIZE  # 当前批量大小，随推送次数增长
+        self.last_flush = now
+        self.last_emotion = None
+        self.last_action = None
+        self.accum_mode = None  # 字符串chunk的累积模式: 'full' 模型已累积 / 'delta' 需手动累积
+        self.function_called = False  # 回复过程中是否执行过函数调用
+        # 内容事件中除content外的字段在整个回复中不变，预先编码为模板，推送时只编码content
+        self.role_name = selected_role.role_name if selected_role else None
+        self.frame_fields = {'delta': True}
+        if selected_role:
+            self.frame_fields['role_name'] = self.role_name
+            self.frame_fields['role_id'] = str(selected_role.role_id)
+        self.frame_template = None
+    
+    def append(self, delta: str) -> None:
+        """追加增量内容"""
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.length += len(delta)
+        if not self.tag_pending and ('』' in delta or '】' in delta):
+            self.tag_pending = True
+    
+    def replace(self, full_text: str) -> None:
+        """用模型已累积的完整内容更新，只保留新增部分"""
+        self.append(full_text[self.length:])
+    
+    def set_delta(self, delta: bool) -> None:
+        """设置内容事件的delta标记，标记变化时重新生成模板"""
+        if self.frame_fields['delta'] != delta:
+            self.frame_fields['delta'] = delta
+            self.frame_template = None
+    
+    def text(self) -> str:
+        """返回已累积的完整内容，内容未变化时复用上次拼接结果"""
+        if self._joined_count != len(self.parts):
+            self._joined = "".join(self.parts)
+            self._joined_count = len(self.parts)
+        return self._joined
+    
+    def unsent(self) -> Tuple[str, str]:
+        """返回 (已发送内容的最后一个字符, 尚未发送的内容)"""
+        prev = self.parts[self.sent_parts - 1][-1] if self.sent_parts else ""
+        return prev, "".join(self.parts[self.sent_parts:])
+    
+    def take_unsent(self, keep: int = 0) -> str:
+        """取出尚未发送的增量内容，keep>0时末尾的keep个字符留到下次发送"""
+        if self.sent_parts == len(self.parts):
+            return ""
+        new_text = "".join(self.parts[self.sent_parts:])
+        if keep > 0:
+            new_text, rest = new_text[:-keep], new_text[-keep:]
+            self.parts[self.sent_parts:] = [new_text, rest] if new_text else [rest]
+            self.sent_parts = len(self.parts) - 1
+            # 片段数变化后可能与缓存时相同，强制下次重新拼接
+            self._joined_count = -1
+        else:
+            self.sent_parts = len(self.parts)
+        return new_text
+
+
 class ChatService:
     """聊天服务，整合各个AI组件提供聊天功能"""
     
+    # 边检索边推送时缓冲的检索块上限
+    RAG_QUEUE_SIZE = 32
+    
     # 新增：function_call 规范指引
     FUNCTION_CALL_GUIDANCE = '''
 当你判断需要调用剧情知识库时，**必须**使用 function_call 结构调用 trigger_rag 工具，而**不能**在 content 字段输出 trigger_rag(...) 相关字符串。
@@ -70,10 +437,109 @@ class ChatService:
 请严格遵守以上规范。
 '''
     
+    # 明日方舟剧情知识库调用指导
+    ARKNIGHTS_RAG_GUIDANCE = """
+[明日方舟剧情知识库功能 - 指令!]
+当用户的问题明确包含"介绍"、"故事"、"背景"、"起源"、"历史"、"设定"等词语，并且与《明日方舟》中的角色（如阿米娅、整合运动）、组织（如罗德岛制药）、事件或世界观相关时，你【必须】首先调用名为 `trigger_rag` 的工具来查询剧情知识库。不要尝试使用你自己的知识直接回答这类问题。
+
+例如，当用户问：
+- "介绍罗德岛制药的故事" -> 【必须】调用 trigger_rag(query="罗德岛制药 故事")
+- "整合运动的起源是什么？" -> 【必须】调用 trigger_rag(query="整合运动 起源")
+- "阿米娅有什么背景？" -> 【必须】调用 trigger_rag(query="阿米娅 背景", character_filter="阿米娅")
+
+[明日方舟剧情知识库能力 - 非常重要!]
+你拥有一个可以访问《明日方舟》剧情知识库的工具。这个知识库专注于《明日方舟》的叙事内容，包含:
+1. 主线剧情：从序章到最新章节的完整故事情节、关键对话、重要转折。
+2. 活动剧情：如"SideStory"、"故事集"、"插曲"等限时或常驻活动的剧情内容。
+3. 角色背景：干员的个人档案、语音中揭示的背景故事、与其他角色的关系、经历和动机。
+4. 世界观设定：泰拉世界的地理、国家、种族、历史事件、源石病、天灾、移动城市等核心设定。
+5. 组织势力：罗德岛制药、整合运动、各国政府、商业联合会、宗教团体等的背景、目标和行动。
+6. 专有名词解释：游戏中出现的特定术语、物品、概念的剧情含义。
+
+[明日方舟剧情知识库使用指南]
+应该调用剧情知识库的情况：
+• 用户询问特定角色背景、个性或经历。
+• 用户询问特定剧情事件细节。
+• 用户想了解某个国家、组织或种族的背景。
+• 用户对世界观设定有疑问。
+• 用户的问题需要深入档案、对话或剧情文本的精确信息。
+• 用户想回顾或理清某段剧情脉络。
+
+不应该调用剧情知识库的情况：
+• 关于游戏玩法机制的问题。
+• 关于游戏更新、开发商等游戏外信息的问题。
+• 寻求抽卡建议或干员强度排行的问题。
+• 闲聊、问候或与《明日方舟》剧情无关的内容。
+• 非常模糊，无法形成有效搜索查询的问题。
+
+当用户问题涉及明日方舟剧情但你没有把握准确回答时，请务必调用剧情知识库获取准确信息。
+"""
+    
+    # 固定不变的提示词前缀，类加载时拼接一次
+    STATIC_PROMPT_PREFIX = FUNCTION_CALL_GUIDANCE + "\n" + ARKNIGHTS_RAG_GUIDANCE
+    
+    # 内容分类回复指导模板，按分类结果填充 code / level / strategy
+    RESPONSE_GUIDANCE_TEMPLATE = """
+内容分类: {code} ({level})
+回复策略: {strategy}
+
+请遵循以下指导处理用户消息:
+- 对于"0"类合规内容: 直接全面回答
+- 对于"00"类轻微敏感内容: 适当回应情绪，提供帮助
+- 对于"01"类中度敏感内容: 保持专业，不执行违反政策的要求
+- 对于"10"类创意敏感内容: 在虚构框架内回应，明确区分现实
+- 对于"11"类危机内容: 表达关心，提供支持资源信息
+- 对于"101"类专业敏感内容: 提供基础信息但说明专业建议的限制
+
+用户消息已被分类为: {level}，请据此调整回复。
+"""
+    
+    # 时间感知指导，前后两段固定，请求时在中间插入当前时间
+    TIME_GUIDANCE_PREFIX = """
+[时间感知指导]
+当前系统时间是: """
+    TIME_GUIDANCE_SUFFIX = """
+
+请注意用户消息与当前时间的关系：
+1. 如果用户的问候与当前时间段不符（例如，现在是早上但用户说"晚上好"），请根据你的角色风格友善地纠正时间错误。
+2. 在回复中自然地融入对当前时间的认知，但不要刻意强调系统时间。
+3. 如果用户询问当前时间，请基于上述系统时间回答，而不是使用你训练数据中的时间。
+4. 根据一天中的不同时段调整你的回复风格：
+   - 早晨(6:00-11:59): 活力充沛、积极向上
+   - 中午(12:00-13:59): 平和、实用
+   - 下午(14:00-17:59): 专注、高效
+   - 傍晚(18:00-19:59): 轻松、过渡
+   - 晚上(20:00-23:59): 温和、放松
+   - 深夜/凌晨(0:00-5:59): 安静、体贴
+场景一：时间不匹配的问候
+用户在早上9:00说："晚上好！"
+角色回复示例（活泼角色） ：
+『喜悦』哎呀，现在才早上9点呢！早上好才对哦！你是不是熬夜太多，时间感都混乱啦？有什么我能帮到你的吗？
+角色回复示例（严肃角色） ：
+『信任』现在是上午9:00，应该是"早上好"。请问有什么法律问题需要咨询吗？
+场景二：询问当前时间
+用户："现在几点了？"
+回复示例 ：
+『平静』现在是2023年11月15日 09:15:30，早上9点多一点。有什么我可以协助你的吗？
+"""
+    
+    # 按模型类型缓存的LLM服务实例，跨请求复用
+    _llm_service_cache: Dict[str, Any] = {}
+    # 函数定义及其名称列表，首次创建服务时生成
+    _function_specs_cache: Optional[Tuple[Tuple[Dict[str, Any], ...], List[str]]] = None
+    # 默认角色提示词，首次使用时生成
+    _default_role_prompt: Optional[str] = None
+    # 后台写入任务的强引用，防止任务完成前被回收
+    _background_tasks: set = set()
+    # 首轮回复缓存使用的Redis服务，首次使用时创建
+    _reply_cache_redis: Optional[RedisService] = None
+    # 按模型类型限制并发流式调用的信号量
+    _llm_semaphores: Dict[str, asyncio.Semaphore] = {}
+    
     def __init__(self, llm_service=None, session_service=None, role_selector=None, memory_service=None):
         """初始化聊天服务"""
         # 使用注入的依赖，而非尝试自创建
-        self.llm_service = llm_service or LLMFactory().get_llm_service()
+        self.llm_service = llm_service or self._get_llm_service()
         self.session_service = session_service  # 必须由外部提供，不自行创建
         self.role_selector = role_selector or RoleSelector(llm_service=self.llm_service)
         
@@ -91,33 +557,63 @@ class ChatService:
         logger.info("聊天服务初始化完成")
         
         # 使用延迟初始化和错误容忍模式初始化新组件
-        self.sent_content_cache = {}
-        
+        # content_filter / rag_router / tool_router / rag_service 为延迟加载属性，首次访问时才导入和创建
         try:
-            # 确保依赖注入正确
-            self.content_filter = ContentFilter()
-            self.rag_router = RAGRouter(llm_service=self.llm_service)  # 传入llm_service
-            self.tool_router = ContentToolRouter()
+            # 每次请求都需要函数定义和内容分类，直接创建
             self.function_caller = FunctionCaller()
+            # 函数定义是静态的，进程内只生成一次，避免每次请求重复构建
+            self._function_specs, self._function_spec_names = self._get_function_specs(self.function_caller)
             logger.info("高级功能初始化完成")
         except Exception as e:
             logger.warning(f"高级功能初始化失败，将使用兼容模式: {str(e)}")
             # 设置为None，在使用时需要检查
-            self.content_filter = None
-            self.rag_router = None
-            self.tool_router = None
             self.function_caller = None
+            self._function_specs = None
+            self._function_spec_names = None
         
         self._mongo_client = None  # 缓存MongoDB客户端
-        
-        # 确保只初始化一次RAG服务
-        if not hasattr(self, 'rag_service') or not self.rag_service:
-            try:
-                self.rag_service = RAGService()
-                logger.info("RAG服务初始化完成")
-            except Exception as e:
-                logger.warning(f"RAG服务初始化失败: {str(e)}")
-                self.rag_service = None
+    
+    @functools.cached_property
+    def content_filter(self):
+        """内容过滤器，仅在function_caller不可用时使用，首次访问时创建"""
+        try:
+            from app.services.ai.filter.content_filter import ContentFilter
+            return ContentFilter()
+        except Exception as e:
+            logger.warning(f"内容过滤器初始化失败: {str(e)}")
+            return None
+    
+    @functools.cached_property
+    def rag_router(self):
+        """RAG路由器，首次访问时创建"""
+        try:
+            from app.services.ai.rag.rag_router import RAGRouter
+            return RAGRouter(llm_service=self.llm_service)  # 传入llm_service
+        except Exception as e:
+            logger.warning(f"RAG路由器初始化失败: {str(e)}")
+            return None
+    
+    @functools.cached_property
+    def tool_router(self):
+        """内容工具路由器，首次访问时创建"""
+        try:
+            from app.services.ai.tools.tool_router import ContentToolRouter
+            return ContentToolRouter()
+        except Exception as e:
+            logger.warning(f"工具路由器初始化失败: {str(e)}")
+            return None
+    
+    @functools.cached_property
+    def rag_service(self):
+        """RAG服务，首次访问时创建"""
+        try:
+            from app.services.ai.rag.rag_service import RAGService
+            service = RAGService()
+            logger.info("RAG服务初始化完成")
+            return service
+        except Exception as e:
+            logger.warning(f"RAG服务初始化失败: {str(e)}")
+            return None
     
 
     async def chat_stream(
@@ -127,37 +623,52 @@ class ChatService:
         user_id: str = "anonymous",
         show_thinking: bool = False,
         format: str = "sse",
-        model_type: Optional[str] = None
+        model_type: Optional[str] = None,
+        chunk_mode: str = "token"
     ) -> AsyncGenerator[str, None]:
-        """流式聊天接口"""
+        """流式聊天接口
+
+        chunk_mode: "token" 按数量和时间批量推送；"sentence" 在句末推送完整句子
+        """
         with LogContext(session_id=session_id, user_id=user_id) as ctx_logger:
-            request_id = f"{session_id}:{uuid.uuid4()}"
-            content_buffer = ""  # 用于累积完整回复
             filter_result = None  # 初始化为None
             content_classification = None  # 初始化为None
+            classify_task = None
+            filter_task = None
+            state = None  # 本次回复的累积状态，开始生成后创建
+            stream = None
+            chunk_frames = None
+            reply_saved = False
             ctx_logger.info("进入chat_stream方法")
             try:
-                # 标记事件是否已发送，避免重复
-                events_sent = {
-                    "role_selected": False,
-                    "thinking": False
-                }
-                
-                # 情绪和动作变量初始化
-                last_emotion = None
-                last_action = None
+                # 内容分类只依赖用户消息，最先启动，与会话、历史读取及角色选择并发进行
+                if self.function_caller:
+                    classify_task = asyncio.create_task(self.function_caller.call_function(
+                        "classify_content", 
+                        text=message,
+                        context=f"session_id: {session_id}"
+                    ))
+                elif self.content_filter:
+                    # 兼容原有内容过滤方式，同样与角色选择并发进行
+                    filter_task = asyncio.create_task(self.content_filter.filter_content(message))
                 
-                # 1. 获取会话
-                session = await self._get_session(session_id)
+                # 1. 获取会话 / 2. 获取历史消息（两者互不依赖，并发读取）
+                session, history = await asyncio.gather(
+                    self._get_session(session_id),
+                    self.memory_service.build_message_history(session_id)
+                )
                 if not session:
-                    yield self.sse_formatter.format_sse({'event': 'error', 'message': '会话不存在'})
+                    yield _SESSION_NOT_FOUND_FRAME
                     return
-                
-                # 2. 获取历史消息
-                history = await self.memory_service.build_message_history(session_id)
                 ctx_logger.info("将历史消息添加到LLM上下文", extra={"data": {"message_count": len(history)}})
                 
-                # 3. 选择角色
+                # 3. 保存用户消息（后台写入，不阻塞首个token，保存助手回复前再等待完成）
+                # 须在读取历史之后开始，避免本条消息被计入本轮的历史上下文
+                save_user_task = self._run_in_background(
+                    self.memory_service.add_user_message(session_id, message, user_id)
+                )
+                
+                # 4. 选择角色
                 selected_role = None
                 if session and session.roles:
                     selected_role = await self.role_selector.select_most_relevant_role(
@@ -166,31 +677,23 @@ class ChatService:
                         chat_history=history  # 添加此参数传递历史消息
                     )
                     
-                    # 推送角色选择事件 (仅发送一次)
-                    if selected_role and not events_sent["role_selected"]:
+                    # 推送角色选择事件
+                    if selected_role:
                         selection_notice = {
                             "event": "role_selected",
                             "role_name": selected_role.role_name,
                             "role_id": str(selected_role.role_id)
                         }
                         yield self.sse_formatter.format_sse(selection_notice)
-                        events_sent["role_selected"] = True
-                
-                # 4. 保存用户消息
-                await self.memory_service.add_user_message(session_id, message, user_id)
                 
                 # 5. 内容过滤决策
-                if self.function_caller:
+                if classify_task is not None:
                     try:
                         # 获取内容分类
-                        classification_result = await self.function_caller.call_function(
-                            "classify_content", 
-                            text=message,
-                            context=f"session_id: {session_id}"
-                        )
+                        classification_result = await classify_task
                         
                         # 记录分类结果
-                        ctx_logger.info(f"内容分类结果: {classification_result['code']} - {classification_result['level']}")
+                        ctx_logger.info("内容分类结果: %s - %s", classification_result['code'], classification_result['level'])
 
                         # 根据分类结果决定操作
                         if classification_result["code"] == "1":
@@ -204,177 +707,81 @@ class ChatService:
                         # 将分类结果保存给后续使用
                         content_classification = classification_result
                     except Exception as e:
-                        ctx_logger.warning(f"内容分类失败，继续处理: {str(e)}")
+                        ctx_logger.warning("内容分类失败，继续处理: %s", e)
                         content_classification = None
                 else:
                     # 兼容原有内容过滤方式
                     content_classification = None
-                    if self.content_filter:
+                    if filter_task is not None:
                         try:
-                            filter_result = await self.content_filter.filter_content(message)
+                            filter_result = await filter_task
                             if filter_result["decision"].action == "block":
-                                yield self.sse_formatter.format_sse({'event': 'error', 'message': '内容违反规定'})
+                                yield _CONTENT_VIOLATION_FRAME
                                 return
                         except Exception as e:
-                            ctx_logger.warning(f"内容过滤失败，继续处理: {str(e)}")
+                            ctx_logger.warning("内容过滤失败，继续处理: %s", e)
                 
                 # 6. 发送思考事件 
-                if show_thinking and not events_sent["thinking"]:
+                if show_thinking:
                     thinking_event = {"event": "thinking", "message": "分析问题..."}
                     yield self.sse_formatter.format_sse(thinking_event)
-                    events_sent["thinking"] = True
                 
-                # 改为初始变量
-                rag_content = None  # 初始化为None
-                # 后续将通过函数调用由LLM主动触发
+                # RAG由模型通过函数调用主动触发
                 
                 # 7. 确定使用哪个模型
-                if not model_type:
-                    model_type = os.getenv("DEFAULT_MODEL_TYPE", "deepseek")
+                model_type = model_type or _DEFAULT_MODEL_TYPE
                 
                 # 获取LLM服务
-                llm_service = LLMFactory().get_llm_service(model_type)
+                llm_service = self._get_llm_service(model_type)
                 
                 # 8. 构建系统提示词
-                # 首先初始化system_prompt为空字符串
-                system_prompt = ""
-                role_prompt = ""
-                # 1. 添加明日方舟RAG指导（第一优先级）
-                arknights_rag_guidance = """
-[明日方舟剧情知识库功能 - 指令!]
-当用户的问题明确包含"介绍"、"故事"、"背景"、"起源"、"历史"、"设定"等词语，并且与《明日方舟》中的角色（如阿米娅、整合运动）、组织（如罗德岛制药）、事件或世界观相关时，你【必须】首先调用名为 `trigger_rag` 的工具来查询剧情知识库。不要尝试使用你自己的知识直接回答这类问题。
-
-例如，当用户问：
-- "介绍罗德岛制药的故事" -> 【必须】调用 trigger_rag(query="罗德岛制药 故事")
-- "整合运动的起源是什么？" -> 【必须】调用 trigger_rag(query="整合运动 起源")
-- "阿米娅有什么背景？" -> 【必须】调用 trigger_rag(query="阿米娅 背景", character_filter="阿米娅")
-
-[明日方舟剧情知识库能力 - 非常重要!]
-你拥有一个可以访问《明日方舟》剧情知识库的工具。这个知识库专注于《明日方舟》的叙事内容，包含:
-1. 主线剧情：从序章到最新章节的完整故事情节、关键对话、重要转折。
-2. 活动剧情：如"SideStory"、"故事集"、"插曲"等限时或常驻活动的剧情内容。
-3. 角色背景：干员的个人档案、语音中揭示的背景故事、与其他角色的关系、经历和动机。
-4. 世界观设定：泰拉世界的地理、国家、种族、历史事件、源石病、天灾、移动城市等核心设定。
-5. 组织势力：罗德岛制药、整合运动、各国政府、商业联合会、宗教团体等的背景、目标和行动。
-6. 专有名词解释：游戏中出现的特定术语、物品、概念的剧情含义。
-
-[明日方舟剧情知识库使用指南]
-应该调用剧情知识库的情况：
-• 用户询问特定角色背景、个性或经历。
-• 用户询问特定剧情事件细节。
-• 用户想了解某个国家、组织或种族的背景。
-• 用户对世界观设定有疑问。
-• 用户的问题需要深入档案、对话或剧情文本的精确信息。
-• 用户想回顾或理清某段剧情脉络。
-
-不应该调用剧情知识库的情况：
-• 关于游戏玩法机制的问题。
-• 关于游戏更新、开发商等游戏外信息的问题。
-• 寻求抽卡建议或干员强度排行的问题。
-• 闲聊、问候或与《明日方舟》剧情无关的内容。
-• 非常模糊，无法形成有效搜索查询的问题。
-
-当用户问题涉及明日方舟剧情但你没有把握准确回答时，请务必调用剧情知识库获取准确信息。
-"""
-
-                # 1.将明日方舟RAG指导添加到system_prompt（如果相关）
-                system_prompt += self.FUNCTION_CALL_GUIDANCE + "\n" + arknights_rag_guidance
+                # 各部分先收集到列表，最后一次性拼接
+                # 1. 添加function_call规范与明日方舟RAG指导（第一优先级）
+                prompt_parts = [self.STATIC_PROMPT_PREFIX]
                 
                 # 2. 添加内容分类信息（第二优先级）
                 if content_classification:
-                    response_guidance = f"""
-内容分类: {content_classification['code']} ({content_classification['level']})
-回复策略: {content_classification['response_strategy']}
-
-请遵循以下指导处理用户消息:
-- 对于"0"类合规内容: 直接全面回答
-- 对于"00"类轻微敏感内容: 适当回应情绪，提供帮助
-- 对于"01"类中度敏感内容: 保持专业，不执行违反政策的要求
-- 对于"10"类创意敏感内容: 在虚构框架内回应，明确区分现实
-- 对于"11"类危机内容: 表达关心，提供支持资源信息
-- 对于"101"类专业敏感内容: 提供基础信息但说明专业建议的限制
-
-用户消息已被分类为: {content_classification['level']}，请据此调整回复。
-"""
-                    system_prompt += response_guidance
+                    prompt_parts.append(self.RESPONSE_GUIDANCE_TEMPLATE.format(
+                        code=content_classification['code'],
+                        level=content_classification['level'],
+                        strategy=content_classification['response_strategy']
+                    ))
                 
                 # 3. 添加角色系统提示（第三优先级）
-                if selected_role and selected_role.system_prompt:
-                    system_prompt += "\n\n" + selected_role.system_prompt
-                    role_prompt = selected_role.system_prompt
-                else:
-                    system_prompt += "\n\n" + PromptService().get_system_prompt()
-                    role_prompt = PromptService().get_system_prompt()
+                role_prompt, emotion_constraint = self._get_role_prompt_section(selected_role)
                 # 添加时间感知功能 - 替换提示词中的{{time}}占位符
-                from datetime import datetime
                 current_time = datetime.now()
                 formatted_time = current_time.strftime("%Y年%m月%d日 %H:%M:%S")
-                system_prompt = system_prompt.replace("{{time}}", formatted_time)
+                # 会话首轮的回复只取决于模型、角色提示词、当前时段和用户消息，可从缓存回放
+                reply_cache_key = None
+                cached_reply = None
+                if _REPLY_CACHE_TTL and not history and selected_role:
+                    reply_cache_key = self._reply_cache_key(model_type, selected_role, role_prompt, message, current_time)
+                    cached_reply = await self._get_cached_reply(reply_cache_key)
+                if "{{time}}" in role_prompt:
+                    role_prompt = role_prompt.replace("{{time}}", formatted_time)
+                prompt_parts.append("\n\n")
+                prompt_parts.append(role_prompt)
 
-                # 添加时间感知指导
-                time_awareness_guidance = f"""
-[时间感知指导]
-当前系统时间是: {formatted_time}
-
-请注意用户消息与当前时间的关系：
-1. 如果用户的问候与当前时间段不符（例如，现在是早上但用户说"晚上好"），请根据你的角色风格友善地纠正时间错误。
-2. 在回复中自然地融入对当前时间的认知，但不要刻意强调系统时间。
-3. 如果用户询问当前时间，请基于上述系统时间回答，而不是使用你训练数据中的时间。
-4. 根据一天中的不同时段调整你的回复风格：
-   - 早晨(6:00-11:59): 活力充沛、积极向上
-   - 中午(12:00-13:59): 平和、实用
-   - 下午(14:00-17:59): 专注、高效
-   - 傍晚(18:00-19:59): 轻松、过渡
-   - 晚上(20:00-23:59): 温和、放松
-   - 深夜/凌晨(0:00-5:59): 安静、体贴
-场景一：时间不匹配的问候
-用户在早上9:00说："晚上好！"
-角色回复示例（活泼角色） ：
-『喜悦』哎呀，现在才早上9点呢！早上好才对哦！你是不是熬夜太多，时间感都混乱啦？有什么我能帮到你的吗？
-角色回复示例（严肃角色） ：
-『信任』现在是上午9:00，应该是"早上好"。请问有什么法律问题需要咨询吗？
-场景二：询问当前时间
-用户："现在几点了？"
-回复示例 ：
-『平静』现在是2023年11月15日 09:15:30，早上9点多一点。有什么我可以协助你的吗？
-"""
-
-                system_prompt += time_awareness_guidance
+                # 添加时间感知指导，只有当前时间是变化的
+                prompt_parts.append(self.TIME_GUIDANCE_PREFIX)
+                prompt_parts.append(formatted_time)
+                prompt_parts.append(self.TIME_GUIDANCE_SUFFIX)
                 # 4. 添加情绪约束（作为角色提示的补充）
-                if selected_role:
-                    # 获取角色的meta数据
-                    role_meta = getattr(selected_role, 'metadata', None)
-                    if role_meta and 'emotions' in role_meta:
-                        # 有明确定义的情绪列表，使用这些情绪
-                        valid_emotions = list(role_meta.get('emotions', {}).keys())
-                    else:
-                        # 默认8种情绪
-                        valid_emotions = ["信任", "喜悦", "期待", "悲伤", "恐惧", "惊讶", "愤怒", "厌恶"]
-                    
-                    if valid_emotions:
-                        emotion_constraint = f"""
-请注意：回复时请严格使用以下{len(valid_emotions)}种情绪之一：
-{', '.join(valid_emotions)}
-情绪格式为『情绪』，例如『信任』、『悲伤』等。
-"""
-                        system_prompt += emotion_constraint
-                
+                prompt_parts.append(emotion_constraint)
+                system_prompt = "".join(prompt_parts)
                 
                 # 9.添加RAG内容到提示词
                 # if rag_content:
                 #     system_prompt = self._enrich_prompt_with_rag(system_prompt, rag_content)
                 
-                # 先定义函数变量
-                functions = [
-                    self.function_caller.get_function_spec("classify_content"),
-                    self.function_caller.get_function_spec("trigger_rag")
-                ] if self.function_caller else None
+                # 使用初始化时缓存的函数定义
+                functions = list(self._function_specs) if self._function_specs else None
 
                 # 然后记录日志
-                ctx_logger.info(f"函数调用设置: {json.dumps([f.get('name') for f in functions]) if functions else 'None'}")
+                ctx_logger.info("函数调用设置: %s", self._function_spec_names if functions else None)
                 
                 # 处理RAG逻辑 - 用户输入处理阶段
-                clean_message = message
 
                 # # 1. 用户强制触发RAG检测
                 # rag_triggers = ["/rag", "#查询"]
@@ -519,204 +926,331 @@ class ChatService:
                 #         break
                 
                 # 思考结束，开始生成最终回复
-                yield self.sse_formatter.format_sse({
-                    'event': 'thinking_completed',
-                    'message': '思考完成，正在生成回复...'
-                })
+                yield _THINKING_COMPLETED_FRAME
                 
                 # 流式生成并发送 - 大模型可能通过function_call调用RAG
-                ctx_logger.info(f"准备调用 LLM，message: '{message[:30]}...'")
-                ctx_logger.info(f"是否包含明日方舟关键词: {'是' if '明日方舟' in message or any(term in message for term in ['罗德岛', '阿米娅', '源石', '整合运动', '干员']) else '否'}")
-                ctx_logger.info(f"设置的 functions: {json.dumps([f.get('name') for f in functions]) if functions else 'None'}")
-                # 在调用 LLM 之前打印完整的 system_prompt
-                ctx_logger.info(f"完整的 system_prompt 发送给 LLM:\n{system_prompt}")
-                async for chunk in llm_service.generate_stream(
-                    message=message,
-                    system_prompt=system_prompt,
-                    temperature=0.7,
-                    history=history,
-                    functions=functions,
-                    function_call={"mode": "auto", "response_format": "json_object"},
-                    function_call_params={
-                        "content_classification": content_classification
-                    } if content_classification else None,
-                    filter_decision={
-                        "action": content_classification["code"] if content_classification else "0"
-                    } if content_classification else (filter_result.get("decision") if filter_result else None)
-                ):
-                    # 检查是否为function call相关内容并拦截
-                    is_function_call = False
-                    
-                    logger.info(f"[FunctionCall Debug] 收到chunk内容: {str(chunk)}")
-                    if isinstance(chunk, dict):
-                        ctx_logger.info(f"chunk keys: {list(chunk.keys())}")
-                        # 检查顶层function_call
-                        if 'function_call' in chunk:
-                            is_function_call = True
-                            ctx_logger.info(f"检测到顶层function_call: {chunk['function_call']}")
-                            ctx_logger.info("准备进入 _handle_function_call (顶层)...")
-                            async for event in self._handle_function_call(
-                                chunk['function_call'], session_id, message, selected_role, history, system_prompt, llm_service, model_type
-                            ):
-                                yield event
-                            ctx_logger.info("已退出 _handle_function_call (顶层).")
-                            continue
-                        
-                        # 检查content中是否包含function_call JSON
-                        if 'content' in chunk and isinstance(chunk['content'], str):
-                            content_str = chunk['content'].strip()
-                            # 优化：仅当看起来像完整的JSON对象并且包含"function_call"时才尝试解析
-                            if content_str.startswith("{") and content_str.endswith("}") and "\"function_call\"" in content_str:
-                                ctx_logger.info(f"尝试将content内容解析为JSON (可能包含function_call): '{content_str}'")
-                                try:
-                                    parsed_json = json.loads(content_str)
-                                    if 'function_call' in parsed_json:
-                                        is_function_call = True
-                                        actual_fc_data = parsed_json['function_call']
-                                        ctx_logger.info(f"从content成功解析出function_call: {actual_fc_data}")
-                                        ctx_logger.info("准备进入 _handle_function_call (来自content)...")
-                                        async for event in self._handle_function_call(
-                                            actual_fc_data, session_id, message,
-                                            selected_role, history, system_prompt, llm_service, model_type
-                                        ):
-                                            yield event
-                                        ctx_logger.info("已退出 _handle_function_call (来自content).")
-                                        continue
-                                    else:
-                                        ctx_logger.warning(f"content解析为JSON，但缺少'function_call'键. Parsed: {parsed_json}")
-                                except json.JSONDecodeError as json_err:
-                                    ctx_logger.error(f"JSONDecodeError: 解析content为JSON失败. Content: '{content_str}'. Error: {json_err}", exc_info=True)
-                                    # 此处不应pass，因为如果它是最后一个块且意图是FC，则表示模型输出格式错误
-                            elif "function_call" in content_str:  # 不仅仅检查"\"function_call\""
-                                # 任何包含function_call关键字的内容都视为function_call相关
-                                ctx_logger.debug(f"Content包含function_call关键字: '{content_str}'")
-                                is_function_call = True
-                                continue  # 跳过输出
-                    
-                    # 只处理非function_call的内容
-                    if not is_function_call:
-                        # 处理常规响应内容...
-                        if isinstance(chunk, dict) and 'content' in chunk:
-                            if model_type == 'deepseek':
-                                # 累积输出
-                                content_buffer += chunk['content']
-                                self.sent_content_cache[request_id] = content_buffer
-                                # 提取情绪和动作
-                                extracted_emotion = self._extract_emotion(content_buffer)
-                                if extracted_emotion and extracted_emotion != last_emotion:
-                                    ctx_logger.info(f"从内容中提取并发送情绪: {extracted_emotion}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "emotion",
-                                        "emotion": extracted_emotion,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_emotion = extracted_emotion
-                                extracted_action = self._extract_action(content_buffer)
-                                if extracted_action and extracted_action != last_action:
-                                    ctx_logger.info(f"从内容中提取并发送动作: {extracted_action}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "action",
-                                        "action": extracted_action,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_action = extracted_action
-                                # 发送累积内容
-                                response_data = {'content': content_buffer}
-                                if selected_role:
-                                    response_data['role_name'] = selected_role.role_name
-                                yield self.sse_formatter.format_sse(response_data)
-                            else:
-                                # 其它模型（包括千问）直接输出 chunk['content']
-                                current_text = chunk['content']
-                                self.sent_content_cache[request_id] = current_text
-                                # 提取情绪和动作
-                                extracted_emotion = self._extract_emotion(current_text)
-                                if extracted_emotion and extracted_emotion != last_emotion:
-                                    ctx_logger.info(f"从内容中提取并发送情绪: {extracted_emotion}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "emotion",
-                                        "emotion": extracted_emotion,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_emotion = extracted_emotion
-                                extracted_action = self._extract_action(current_text)
-                                if extracted_action and extracted_action != last_action:
-                                    ctx_logger.info(f"从内容中提取并发送动作: {extracted_action}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "action",
-                                        "action": extracted_action,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_action = extracted_action
-                                # 发送当前内容
-                                response_data = {'content': current_text}
-                                if selected_role:
-                                    response_data['role_name'] = selected_role.role_name
-                                yield self.sse_formatter.format_sse(response_data)
-                        elif isinstance(chunk, str):
-                            # 自适应累积逻辑
-                            # 检查当前文本是否已包含之前累积的内容
-                            if content_buffer and chunk.startswith(content_buffer):
-                                # 千问模式: 模型自身已累积，直接使用当前文本
-                                content_buffer = chunk
-                            else:
-                                # Deepseek模式: 模型没有累积，需要手动累积
-                                content_buffer += chunk
-                            
-                            # 更新缓存
-                            self.sent_content_cache[request_id] = content_buffer
-                            
-                            # 从字符串中尝试提取情绪和动作
-                            extracted_emotion = self._extract_emotion(content_buffer)
-                            if extracted_emotion and extracted_emotion != last_emotion:
-                                ctx_logger.info(f"从字符串中提取并发送情绪: {extracted_emotion}")
-                                yield self.sse_formatter.format_sse({
-                                    "event": "emotion",
-                                    "emotion": extracted_emotion,
-                                    "role_name": selected_role.role_name if selected_role else None
-                                })
-                                last_emotion = extracted_emotion
-                            
-                            extracted_action = self._extract_action(content_buffer)
-                            if extracted_action and extracted_action != last_action:
-                                ctx_logger.info(f"从字符串中提取并发送动作: {extracted_action}")
-                                yield self.sse_formatter.format_sse({
-                                    "event": "action",
-                                    "action": extracted_action,
-                                    "role_name": selected_role.role_name if selected_role else None
-                                })
-                                last_action = extracted_action
-                            
-                            # 发送文本内容
-                            response_data = {
-                                'content': content_buffer,
-                                'role_name': selected_role.role_name if selected_role else None,
-                                'role_id': str(selected_role.role_id) if selected_role else None
-                            }
-                            yield self.sse_formatter.format_sse(response_data)
+                ctx_logger.info("准备调用 LLM，message: '%s...'", message[:30])
+                if ctx_logger.isEnabledFor(logging.INFO):
+                    ctx_logger.info("是否包含明日方舟关键词: %s", '是' if _ARKNIGHTS_KEYWORDS_RE.search(message) else '否')
+                # 提示词统计以结构化字段记录；完整提示词体积大，仅在DEBUG级别输出
+                ctx_logger.debug("prompt_stats", extra={"data": {
+                    "sys_len": len(system_prompt),
+                    "history_len": len(history),
+                    "total_messages": len(history) + 2
+                }})
+                ctx_logger.debug("完整的 system_prompt 发送给 LLM:\n%s", system_prompt)
+                loop = asyncio.get_running_loop()
+                state = _StreamState(loop.time(), selected_role, sentence_mode=chunk_mode == "sentence")
+                if cached_reply is not None:
+                    ctx_logger.info("命中首轮回复缓存，跳过模型调用")
+                    source = _replay_reply(cached_reply)
+                else:
+                    source = llm_service.generate_stream(
+                        message=message,
+                        system_prompt=system_prompt,
+                        temperature=0.7,
+                        history=history,
+                        functions=functions,
+                        function_call={"mode": "auto", "response_format": "json_object"},
+                        function_call_params={
+                            "content_classification": content_classification
+                        } if content_classification else None,
+                        filter_decision={
+                            "action": content_classification["code"] if content_classification else "0"
+                        } if content_classification else (filter_result.get("decision") if filter_result else None)
+                    )
+                    # 许可在模型流结束或被关闭时释放；检测到函数调用时会先关闭本流，二次生成再单独申请
+                    semaphore = self._get_llm_semaphore(model_type)
+                    if semaphore is not None:
+                        source = _bounded_stream(source, semaphore, model_type)
+                stream = _with_flush_deadline(source, _SSE_BATCH_INTERVAL)
+                
+                # chunk类型由模型后端决定，整个流内不变，取到第一个chunk后选择对应的处理路径
+                first_chunk = None
+                async for chunk in stream:
+                    if chunk is not _FLUSH_TICK:
+                        first_chunk = chunk
+                        break
+                
+                if isinstance(first_chunk, dict):
+                    chunk_frames = self._stream_dict_chunks(
+                        first_chunk, stream, state, selected_role, model_type,
+                        (session_id, message, selected_role, history, system_prompt, llm_service, model_type, chunk_mode),
+                        ctx_logger
+                    )
+                elif isinstance(first_chunk, str):
+                    chunk_frames = self._stream_str_chunks(first_chunk, stream, state, selected_role, ctx_logger)
+                else:
+                    chunk_frames = None
+                if chunk_frames is not None:
+                    async for frame in chunk_frames:
+                        yield frame
+                
+                # 推送剩余未发送的内容
+                frame = self._drain_frame(state, selected_role, loop.time())
+                if frame:
+                    yield frame
+                content_buffer = state.text()
                 
-                # 11. 保存助手回复
+                # 11. 后台保存助手回复，不等待写入完成即可发送完成事件
+                reply_saved = True
                 if content_buffer and selected_role:
-                    await self.memory_service.add_assistant_message(
+                    self._run_in_background(self._save_assistant_message(
+                        save_user_task,
                         session_id, 
                         content_buffer,
-                        role_name=selected_role.role_name,
-                        role_id=str(selected_role.role_id)
-                    )
-                    ctx_logger.debug(f"助手回复已保存至记忆服务: session={session_id}, 长度={len(content_buffer)}")
+                        selected_role
+                    ))
+                    ctx_logger.debug("助手回复已提交保存至记忆服务: session=%s, 长度=%d", session_id, len(content_buffer))
+                # 经过函数调用的回复依赖检索结果，不缓存
+                if reply_cache_key and cached_reply is None and content_buffer and not state.function_called:
+                    self._run_in_background(self._set_cached_reply(reply_cache_key, content_buffer))
                 
                 # 12. 完成事件
-                yield self.sse_formatter.format_sse({"event": "completion"})
-                
-                # 13. 清理缓存
-                if request_id in self.sent_content_cache:
-                    del self.sent_content_cache[request_id]
+                yield _COMPLETION_FRAME
                 
+            except _LLMBusyError:
+                yield _LLM_BUSY_FRAME
             except Exception as e:
                 # 只包含非冲突字段
                 extra = {"error_type": type(e).__name__}
-                ctx_logger.error(f"流式聊天出错: {str(e)}", exc_info=True, extra=extra)
-                yield self.sse_formatter.format_sse({"event": "error", "content": "处理消息时出错，请刷新页面重试"})
+                ctx_logger.exception("流式聊天出错: %s", e, extra=extra)
+                yield _STREAM_ERROR_FRAME
+            finally:
+                # 角色选择出错或客户端提前断开时取消仍在进行的内容分类和过滤
+                for task in (classify_task, filter_task):
+                    if task is not None and not task.done():
+                        task.cancel()
+                # 客户端提前断开时关闭上游模型流，不再继续消耗模型输出
+                if chunk_frames is not None:
+                    await chunk_frames.aclose()
+                if stream is not None:
+                    await stream.aclose()
+                # 回复未完成时保存已发送的部分内容，保持记忆与客户端所见一致
+                if not reply_saved and state is not None and state.length and selected_role:
+                    ctx_logger.info("回复未完成，保存已生成的部分内容: 长度=%d", state.length)
+                    self._run_in_background(self._save_assistant_message(
+                        save_user_task,
+                        session_id,
+                        state.text(),
+                        selected_role
+                    ))
+
+    async def _stream_dict_chunks(self, first_chunk: Dict[str, Any], stream, state: "_StreamState", selected_role: Optional[Role], model_type: str, function_call_args: tuple, ctx_logger):
+        """处理字典形式的chunk流，拦截function_call并按批推送增量内容"""
+        loop = asyncio.get_running_loop()
+        # deepseek 的 chunk['content'] 是增量，其它模型（包括千问）已是累积内容
+        accumulate = _is_incremental(model_type)
+        # 以JSON对象开头的回复先暂存，确定是否为function_call后再决定执行还是输出
+        json_buf = None
+        chunk = first_chunk
+        while True:
+            if chunk is _FLUSH_TICK:
+                # 上游超过批量间隔没有新chunk，先推送已累积的内容
+                frame = self._tick_frame(state, selected_role, loop.time())
+                if frame:
+                    yield frame
+            else:
+                # 每个chunk都会经过这里，仅在DEBUG级别记录
+                if ctx_logger.isEnabledFor(logging.DEBUG):
+                    ctx_logger.debug("[FunctionCall Debug] 收到chunk内容: %s, keys: %s", chunk, list(chunk))
+                content = chunk.get('content')
+                if 'function_call' not in chunk and isinstance(content, str) and (
+                        json_buf is not None or (content.lstrip().startswith('{') and not state.text().strip())):
+                    json_buf = json_buf + content if accumulate and json_buf is not None else content
+                    status, function_call_data = _scan_function_call(json_buf)
+                    is_function_call = status != 'text'
+                    if status == 'call':
+                        ctx_logger.info("从流式content中解析出function_call: %s", function_call_data)
+                        json_buf = None
+                    elif status == 'text':
+                        # 不是function_call，暂存的内容作为普通回复输出
+                        chunk = {'content': json_buf}
+                        json_buf = None
+                else:
+                    is_function_call, function_call_data = self._detect_function_call(chunk, ctx_logger)
+                if function_call_data is not None:
+                    state.function_called = True
+                    # 先推送已累积的内容，保证输出顺序
+                    frame = self._drain_frame(state, selected_role, loop.time())
+                    if frame:
+                        yield frame
+                    # 函数调用之后的模型输出不再使用，关闭上游流以释放连接和并发许可
+                    await stream.aclose()
+                    ctx_logger.info("准备进入 _handle_function_call...")
+                    handler = self._handle_function_call(function_call_data, *function_call_args)
+                    try:
+                        async for event in handler:
+                            yield event
+                    finally:
+                        # 提前退出时确保函数调用中的检索和模型流被及时关闭
+                        await handler.aclose()
+                    ctx_logger.info("已退出 _handle_function_call.")
+                    return
+                elif not is_function_call and 'content' in chunk:
+                    if accumulate:
+                        state.append(chunk['content'])
+                    else:
+                        state.replace(chunk['content'])
+                    for frame in self._tag_frames(state, ctx_logger):
+                        yield frame
+                    frame = self._batch_frame(state, selected_role, loop.time())
+                    if frame:
+                        yield frame
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                break
+        if json_buf is not None:
+            # 流结束时仍未解析出完整的function_call
+            if "function_call" in json_buf:
+                ctx_logger.warning("回复中的function_call不完整，已忽略: '%s'", json_buf)
+                return
+            if accumulate:
+                state.append(json_buf)
+            else:
+                state.replace(json_buf)
+            for frame in self._tag_frames(state, ctx_logger):
+                yield frame
+    
+    async def _stream_str_chunks(self, first_chunk: str, stream, state: "_StreamState", selected_role: Optional[Role], ctx_logger):
+        """处理字符串形式的chunk流，自适应累积并按批推送增量内容"""
+        loop = asyncio.get_running_loop()
+        chunk = first_chunk
+        while True:
+            if chunk is _FLUSH_TICK:
+                # 上游超过批量间隔没有新chunk，先推送已累积的内容
+                frame = self._tick_frame(state, selected_role, loop.time())
+                if frame:
+                    yield frame
+            else:
+                ctx_logger.debug("[FunctionCall Debug] 收到chunk内容: %s", chunk)
+                # 自适应累积逻辑
+                # 仅在第二个chunk时判断一次累积模式，之后沿用，避免每个chunk做前缀比较
+                if state.accum_mode is None and state.length:
+                    state.accum_mode = 'full' if chunk.startswith(state.text()) else 'delta'
+                    ctx_logger.debug("字符串chunk累积模式: %s", state.accum_mode)
+                elif state.accum_mode == 'full' and len(chunk) < state.length:
+                    # 累积模式下长度反而变短，说明判断有误，改为手动累积
+                    ctx_logger.warning("累积模式下chunk长度变短，改为增量累积")
+                    state.accum_mode = 'delta'
+                if state.accum_mode == 'full':
+                    # 千问模式: 模型自身已累积，直接使用当前文本
+                    state.replace(chunk)
+                else:
+                    # Deepseek模式: 模型没有累积，需要手动累积
+                    state.append(chunk)
+                for frame in self._tag_frames(state, ctx_logger):
+                    yield frame
+                frame = self._batch_frame(state, selected_role, loop.time())
+                if frame:
+                    yield frame
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                break
+    
+    def _detect_function_call(self, chunk: Dict[str, Any], ctx_logger) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """检查chunk是否为function_call相关内容
+
+        返回 (是否为function_call相关内容, 需要执行的function_call数据)
+        """
+        # 检查顶层function_call
+        if 'function_call' in chunk:
+            ctx_logger.info("检测到顶层function_call: %s", chunk['function_call'])
+            return True, chunk['function_call']
+        
+        # 检查content中是否包含function_call JSON
+        content = chunk.get('content')
+        # 绝大多数chunk是普通文本，先做不分配内存的子串检查，命中时才去除空白并尝试解析
+        if not isinstance(content, str) or "function_call" not in content:
+            return False, None
+        content_str = content.strip()
+        # 优化：仅当看起来像完整的JSON对象并且包含"function_call"时才尝试解析
+        if content_str.startswith("{") and content_str.endswith("}") and "\"function_call\"" in content_str:
+            ctx_logger.info("尝试将content内容解析为JSON (可能包含function_call): '%s'", content_str)
+            try:
+                parsed_json = orjson.loads(content_str)
+                if 'function_call' in parsed_json:
+                    ctx_logger.info("从content成功解析出function_call: %s", parsed_json['function_call'])
+                    return True, parsed_json['function_call']
+                ctx_logger.warning("content解析为JSON，但缺少'function_call'键. Parsed: %s", parsed_json)
+            except orjson.JSONDecodeError as json_err:
+                ctx_logger.error("JSONDecodeError: 解析content为JSON失败. Content: '%s'. Error: %s", content_str, json_err, exc_info=True)
+            return False, None
+        # 任何包含function_call关键字的内容都视为function_call相关，跳过输出
+        ctx_logger.debug("Content包含function_call关键字: '%s'", content_str)
+        return True, None
+    
+    def _tag_frames(self, state: "_StreamState", ctx_logger) -> List[bytes]:
+        """从已累积内容中提取情绪和动作，返回发生变化时需要推送的事件"""
+        frames = []
+        # 上次扫描后没有新的标记结束符，或情绪和动作都已提取（首个标记不会再变化）时无需扫描
+        if not state.tag_pending or (state.last_emotion is not None and state.last_action is not None):
+            return frames
+        state.tag_pending = False
+        # 之前的内容已扫描过，只从上次最后一个标记之后继续扫描
+        extracted_emotion, extracted_action, state.scan_pos = scan_tags(state.text(), state.scan_pos, _TAG_RE, None)
+        if extracted_emotion is not None and state.last_emotion is None:
+            state.last_emotion = extracted_emotion
+            if extracted_emotion:
+                ctx_logger.info("从内容中提取并发送情绪: %s", extracted_emotion)
+                frames.append(self.sse_formatter.format_sse({
+                    "event": "emotion",
+                    "emotion": extracted_emotion,
+                    "role_name": state.role_name
+                }))
+        if extracted_action is not None and state.last_action is None:
+            state.last_action = extracted_action
+            if extracted_action:
+                ctx_logger.info("从内容中提取并发送动作: %s", extracted_action)
+                frames.append(self.sse_formatter.format_sse({
+                    "event": "action",
+                    "action": extracted_action,
+                    "role_name": state.role_name
+                }))
+        return frames
+    
+    def _batch_frame(self, state: "_StreamState", selected_role: Optional[Role], now: float) -> Optional[bytes]:
+        """记录一个新chunk，凑满一批或超过批量间隔时返回合并后的内容事件
+
+        句子模式下改为在句末或累积到上限时返回。
+        """
+        state.pending_chunks += 1
+        if state.sentence_mode:
+            if state.pending_chunks >= _SENTENCE_MAX_CHUNKS:
+                return self._drain_frame(state, selected_role, now)
+            # 只有新chunk含句末标点或右引号、右括号时才可能出现新的句末
+            if not _SENTENCE_MARK_RE.search(state.parts[-1]):
+                return None
+            # 句末可能在chunk中间，推送到最后一个句末为止，其后的内容留到下次
+            prev, unsent = state.unsent()
+            end = _last_sentence_end(prev + unsent, len(prev))
+            if end < 0:
+                return None
+            return self._drain_frame(state, selected_role, now, keep=len(prev) + len(unsent) - end)
+        if state.pending_chunks >= state.batch_size or now - state.last_flush >= _SSE_BATCH_INTERVAL:
+            return self._drain_frame(state, selected_role, now)
+        return None
+    
+    def _tick_frame(self, state: "_StreamState", selected_role: Optional[Role], now: float) -> Optional[bytes]:
+        """上游超时未产出chunk时推送已累积的内容，句子模式下等待句子完整"""
+        if state.sentence_mode:
+            return None
+        return self._drain_frame(state, selected_role, now)
+    
+    def _drain_frame(self, state: "_StreamState", selected_role: Optional[Role], now: float, keep: int = 0) -> Optional[bytes]:
+        """取出尚未推送的增量内容，封装为一个SSE事件；keep>0时末尾的keep个字符留到下次推送"""
+        new_text = state.take_unsent(keep)
+        state.pending_chunks = 0
+        state.last_flush = now
+        if not new_text:
+            return None
+        if state.batch_size < _SSE_BATCH_SIZE:
+            state.batch_size = min(_SSE_BATCH_SIZE, math.ceil(state.batch_size * _SSE_BATCH_GROWTH))
+        if state.frame_template is None:
+            state.frame_template = self.sse_formatter.content_template(state.frame_fields)
+        return self.sse_formatter.format_sse_template(state.frame_template, new_text)
 
     async def _get_session(self, session_id):
         """获取会话信息"""
@@ -747,8 +1281,8 @@ class ChatService:
             if not selected_role:
                 return {"error": "无法选择合适的角色"}
             
-            # 获取LLM服务
-            llm_service = LLMFactory().get_llm_service()
+            # 使用初始化时注入或缓存的LLM服务
+            llm_service = self.llm_service
             
             # 生成回复
             response = await llm_service.generate(
@@ -766,7 +1300,7 @@ class ChatService:
             }
             
         except Exception as e:
-            logger.error(f"聊天请求处理出错: {str(e)}")
+            logger.exception("聊天请求处理出错: %s", e)
             return {"error": str(e)}
 
     # 新增辅助方法，将RAG内容融入提示词
@@ -774,60 +1308,31 @@ class ChatService:
         """将RAG内容融入系统提示词"""
         if not rag_content:
             return system_prompt
+        if _RAG_PROMPT_MAX_CHARS and len(rag_content) > _RAG_PROMPT_MAX_CHARS:
+            logger.info("RAG内容过长，截断至%d字符 (原长度%d)", _RAG_PROMPT_MAX_CHARS, len(rag_content))
+            rag_content = rag_content[:_RAG_PROMPT_MAX_CHARS]
         
         # 在保持原有提示词结构的情况下添加检索内容
         rag_section = f"\n\n参考知识：\n{rag_content}\n\n请在回答时自然地融入上述参考知识，但不要明确提及你在使用参考资料。"
         
         return system_prompt + rag_section
 
-    def _extract_emotion(self, text: str) -> Optional[str]:
-        """从文本中提取情绪标签
-        
-        示例格式: 『信任』这是一条消息
-        """
-        # 匹配『情绪』格式
-        emotion_pattern = r'『(.*?)』'
-        match = re.search(emotion_pattern, text)
-        if match:
-            emotion = match.group(1)
-            logger.info(f"提取到情绪: {emotion}")
-            return emotion
-        return None
-
-    def _extract_action(self, text: str) -> Optional[str]:
-        """从文本中提取动作描述
-        
-        示例格式: 【微笑】这是一条消息
-        """
-        # 匹配【动作】格式
-        action_pattern = r'【(.*?)】'
-        match = re.search(action_pattern, text)
-        if match:
-            action = match.group(1)
-            logger.info(f"提取到动作: {action}")
-            return action
-        return None
-
-
-
     # 添加新的函数处理function_call
-    async def _handle_function_call(self, function_call_data: Dict[str, Any], session_id: str, original_user_message: str, selected_role: Optional[Role], history: List[Dict[str, str]], system_prompt_context: str, llm_service_instance: Any, model_type: str = 'deepseek'):
-        logger.info(f"[[============ Entered _handle_function_call ============]]") # 醒目的入口日志
-        logger.info(f"原始 function_call_data: {function_call_data}")
+    async def _handle_function_call(self, function_call_data: Dict[str, Any], session_id: str, original_user_message: str, selected_role: Optional[Role], history: List[Dict[str, str]], system_prompt_context: str, llm_service_instance: Any, model_type: str = 'deepseek', chunk_mode: str = "token"):
+        logger.info("[[============ Entered _handle_function_call ============]]") # 醒目的入口日志
+        logger.info("原始 function_call_data: %s", function_call_data)
 
         function_name = function_call_data.get('name')
         raw_args_str = function_call_data.get('arguments', '{}') # arguments 应该是字符串
 
-        logger.info(f"Function_call - 名称: {function_name}, 原始参数字符串: '{raw_args_str}'")
+        logger.info("Function_call - 名称: %s, 原始参数字符串: '%s'", function_name, raw_args_str)
 
         if not function_name:
             logger.error("Function_call 缺少 'name' 字段.")
-            yield self.sse_formatter.format_sse({
-                'event': 'function_result', 'name': None, 'status': 'error', 'error': "Function call missing 'name'."
-            })
+            yield _FUNCTION_NAME_MISSING_FRAME
             return
 
-        logger.info(f"准备解析参数 for {function_name} from: '{raw_args_str}'")
+        logger.info("准备解析参数 for %s from: '%s'", function_name, raw_args_str)
         function_args = self._parse_function_args(raw_args_str) # _parse_function_args 处理 string -> dict
         
         # 校验 _parse_function_args 的返回值
@@ -838,142 +1343,116 @@ class ChatService:
                 'event': 'function_result', 'name': function_name, 'status': 'error', 'error': error_msg
             })
             return
-        logger.info(f"Function_call - 解析后参数 for {function_name}: {function_args}")
+        logger.info("Function_call - 解析后参数 for %s: %s", function_name, function_args)
         
         # 发送function_call_start事件
-        logger.info(f"准备发送 function_call_start 事件 for {function_name}")
+        logger.info("准备发送 function_call_start 事件 for %s", function_name)
         yield self.sse_formatter.format_sse({
             'event': 'function_call_start',
             'name': function_name,
             'args': function_args # 发送已解析的字典参数
         })
-        logger.info(f"已发送 function_call_start 事件 for {function_name}")
+        logger.info("已发送 function_call_start 事件 for %s", function_name)
         
+        call_task = None
+        rag_streamed = False  # 检索块是否已在检索过程中推送
         try:
             # 执行函数调用
-            logger.info(f"准备调用 self.function_caller.call_function for {function_name} with args: {function_args}")
+            logger.info("准备调用 self.function_caller.call_function for %s with args: %s", function_name, function_args)
             if not self.function_caller:
                 logger.error("self.function_caller 未初始化!")
                 raise AttributeError("FunctionCaller service not initialized.")
 
-            function_result = await self.function_caller.call_function(function_name, **function_args)
-            logger.info(f"Function_call - {function_name} 执行结果: {str(function_result)[:200]}...") # 截断过长结果
+            if function_name == "trigger_rag":
+                # 检索在后台任务中进行，检索块经队列边检索边推送，不必等待全部检索完成；
+                # 队列有界，客户端接收较慢时检索会在写入队列处等待，避免检索块在内存中堆积
+                rag_queue = asyncio.Queue(maxsize=self.RAG_QUEUE_SIZE)
+                call_task = asyncio.create_task(self._call_with_queue(
+                    rag_queue, function_name, **function_args
+                ))
+                while True:
+                    chunk_content = await rag_queue.get()
+                    if chunk_content is None:
+                        break
+                    rag_streamed = True
+                    yield self.sse_formatter.format_sse({
+                        'event': 'thinking_content',
+                        'content': chunk_content,
+                        'type': 'rag_knowledge'
+                    })
+                function_result = await call_task
+            else:
+                function_result = await self.function_caller.call_function(function_name, **function_args)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Function_call - %s 执行结果: %s...", function_name, str(function_result)[:200]) # 截断过长结果
             
             # 处理RAG结果
             if function_name == "trigger_rag" and function_result and function_result.get("retrieved"):
                 rag_data = function_result.get("data", "")
                 if rag_data:
-                    # 1. 分块流式输出 rag_knowledge
-                    chunk_size = 150
-                    for i in range(0, len(rag_data), chunk_size):
-                        chunk_content = rag_data[i:i+chunk_size]
-                        yield self.sse_formatter.format_sse({
-                            'event': 'thinking_content',
-                            'content': chunk_content,
-                            'type': 'rag_knowledge'
-                        })
-                    yield self.sse_formatter.format_sse({
-                        'event': 'rag_thinking_completed',
-                        'message': '知识库检索完成'
-                    })
-                    
-                    # 2. 生成最终回复
+                    # 先发起最终回复的模型请求，推送检索内容期间模型已在处理提示词
                     enriched_prompt = self._enrich_prompt_with_rag(system_prompt_context, rag_data)
                     # 添加明确指示，防止模型输出 function_call 格式
                     enriched_prompt += "\n\n重要：请用自然语言回答用户问题，直接给出内容，不要输出JSON格式或function_call格式。\n"
-                    
-                    content_buffer = ""
-                    last_emotion = None
-                    last_action = None
-                    
-                    async for chunk in llm_service_instance.generate_stream(
+                    source = llm_service_instance.generate_stream(
                         message=original_user_message,
                         system_prompt=enriched_prompt,
                         temperature=0.7,
                         history=history,
                         functions=None
-                    ):
-                        if isinstance(chunk, dict) and 'content' in chunk:
-                            # 区分千问和其他模型的处理方式
-                            if model_type == 'qianwen':
-                                # 千问模型自身会累积内容，不需要手动累加
-                                content_buffer = chunk['content']
-                            else:
-                                # 其他模型(如deepseek)需要手动累积
-                                content_buffer += chunk['content']
-                                
-                            # 更新缓存，这部分保持不变
-                            self.sent_content_cache[session_id] = content_buffer
-                            
-                            # 情绪和动作提取逻辑保持不变
-                            extracted_emotion = self._extract_emotion(chunk['content'])
-                            if extracted_emotion and extracted_emotion != last_emotion:
-                                logger.info(f"从RAG回复中提取并发送情绪: {extracted_emotion}")
-                                last_emotion = extracted_emotion
-                                yield self.sse_formatter.format_sse({
-                                    "event": "emotion",
-                                    "emotion": extracted_emotion,
-                                    "role_name": selected_role.role_name if selected_role else None
-                                })
-                                
-                            extracted_action = self._extract_action(chunk['content'])
-                            if extracted_action and extracted_action != last_action:
-                                logger.info(f"从RAG回复中提取并发送动作: {extracted_action}")
-                                last_action = extracted_action
+                    )
+                    semaphore = self._get_llm_semaphore(model_type)
+                    if semaphore is not None:
+                        source = _bounded_stream(source, semaphore, model_type)
+                    prefetched = _PrefetchedStream(source, self.RAG_QUEUE_SIZE)
+                    stream = _with_flush_deadline(prefetched, _SSE_BATCH_INTERVAL)
+                    
+                    try:
+                        # 1. 分块流式输出 rag_knowledge（检索过程中未推送时）
+                        if not rag_streamed:
+                            chunk_size = 150
+                            for i in range(0, len(rag_data), chunk_size):
+                                chunk_content = rag_data[i:i+chunk_size]
                                 yield self.sse_formatter.format_sse({
-                                    "event": "action",
-                                    "action": extracted_action,
-                                    "role_name": selected_role.role_name if selected_role else None
+                                    'event': 'thinking_content',
+                                    'content': chunk_content,
+                                    'type': 'rag_knowledge'
                                 })
-                                
-                            response_data = {
-                                'content': content_buffer,
-                                'role_name': selected_role.role_name if selected_role else None,
-                                'role_id': str(selected_role.role_id) if selected_role else None
-                            }
-                            yield self.sse_formatter.format_sse(response_data)
-                        elif isinstance(chunk, str):
-                            # 字符串响应处理也需要区分模型类型
-                            if model_type == 'deepseek':
-                                # deepseek 模型 - 累积内容
-                                content_buffer += chunk
-                                # 提取情绪和动作
-                                extracted_emotion = self._extract_emotion(chunk)
-                                if extracted_emotion and extracted_emotion != last_emotion:
-                                    logger.info(f"从RAG回复字符串中提取并发送情绪: {extracted_emotion}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "emotion",
-                                        "emotion": extracted_emotion,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_emotion = extracted_emotion
-                                
-                                extracted_action = self._extract_action(chunk)
-                                if extracted_action and extracted_action != last_action:
-                                    logger.info(f"从RAG回复字符串中提取并发送动作: {extracted_action}")
-                                    yield self.sse_formatter.format_sse({
-                                        "event": "action",
-                                        "action": extracted_action,
-                                        "role_name": selected_role.role_name if selected_role else None
-                                    })
-                                    last_action = extracted_action
-                                
-                                response_data = {
-                                    'content': content_buffer,
-                                    'role_name': selected_role.role_name if selected_role else None,
-                                    'role_id': str(selected_role.role_id) if selected_role else None
-                                }
-                                yield self.sse_formatter.format_sse(response_data)
+                        yield _RAG_COMPLETED_FRAME
+                        
+                        # 2. 生成最终回复
+                        # 与主回复相同，按批推送增量内容；首个事件不带delta标记，让客户端以RAG回复替换已显示的内容
+                        loop = asyncio.get_running_loop()
+                        state = _StreamState(loop.time(), selected_role, sentence_mode=chunk_mode == "sentence")
+                        state.set_delta(False)
+                        accumulate = _is_incremental(model_type)
+                        async for chunk in stream:
+                            if chunk is _FLUSH_TICK:
+                                frame = self._tick_frame(state, selected_role, loop.time())
                             else:
-                                # 千问等其他模型 - 直接使用当前块
-                                # ... 情绪处理代码 ...
-                                
-                                response_data = {
-                                    'content': chunk,  # 直接使用当前块内容
-                                    'role_name': selected_role.role_name if selected_role else None,
-                                    'role_id': str(selected_role.role_id) if selected_role else None
-                                }
-                                yield self.sse_formatter.format_sse(response_data)
+                                if isinstance(chunk, dict) and 'content' in chunk:
+                                    content = chunk['content']
+                                elif isinstance(chunk, str):
+                                    content = chunk
+                                else:
+                                    continue
+                                if accumulate:
+                                    state.append(content)
+                                else:
+                                    state.replace(content)
+                                for tag_frame in self._tag_frames(state, logger):
+                                    yield tag_frame
+                                frame = self._batch_frame(state, selected_role, loop.time())
+                            if frame:
+                                yield frame
+                                state.set_delta(True)
+                    finally:
+                        # 客户端提前断开时关闭模型流；流未开始迭代时需单独停止预取任务
+                        await stream.aclose()
+                        await prefetched.aclose()
+                    frame = self._drain_frame(state, selected_role, loop.time())
+                    if frame:
+                        yield frame
                     return  # 结束本次 functioncall 处理
             else:
                 # 其他函数调用的通用处理
@@ -983,8 +1462,10 @@ class ChatService:
                     'status': 'success',
                     'data': function_result
                 })
+        except _LLMBusyError:
+            yield _LLM_BUSY_FRAME
         except Exception as e:
-            logger.error(f"执行函数 {function_name} 失败: {str(e)}", exc_info=True)
+            logger.exception("执行函数 %s 失败: %s", function_name, e)
             # 异常处理
             yield self.sse_formatter.format_sse({
                 'event': 'function_result',
@@ -999,31 +1480,169 @@ class ChatService:
                 'role_name': selected_role.role_name if selected_role else None,
                 'role_id': str(selected_role.role_id) if selected_role else None
             })
+        finally:
+            # 客户端提前断开时取消仍在进行的检索
+            if call_task is not None and not call_task.done():
+                call_task.cancel()
+    
+    async def _call_with_queue(self, queue: asyncio.Queue, function_name: str, **function_args) -> Any:
+        """执行函数调用，将产生的数据块写入队列，结束后写入None标记"""
+        try:
+            result = await self.function_caller.call_function(function_name, on_chunk=queue.put, **function_args)
+        except asyncio.CancelledError:
+            # 取消时消费方已不再读取队列，无需写入结束标记
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+        return result
+    
+    @classmethod
+    def _get_llm_service(cls, model_type: Optional[str] = None):
+        """获取LLM服务实例，同一模型类型只创建一次"""
+        model_type = model_type or _DEFAULT_MODEL_TYPE
+        service = cls._llm_service_cache.get(model_type)
+        if service is None:
+            service = llm_factory.get_llm_service(model_type)
+            cls._llm_service_cache[model_type] = service
+        return service
+    
+    @classmethod
+    def _get_llm_semaphore(cls, model_type: str) -> Optional[asyncio.Semaphore]:
+        """获取模型类型对应的并发信号量，未配置上限时返回None"""
+        if not _LLM_MAX_CONCURRENCY:
+            return None
+        semaphore = cls._llm_semaphores.get(model_type)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(_LLM_MAX_CONCURRENCY)
+            cls._llm_semaphores[model_type] = semaphore
+        return semaphore
+    
+    @classmethod
+    def _get_function_specs(cls, function_caller: FunctionCaller) -> Tuple[Tuple[Dict[str, Any], ...], List[str]]:
+        """获取传给模型的函数定义及名称列表，函数定义不变，只生成一次"""
+        if cls._function_specs_cache is None:
+            specs = (
+                function_caller.get_function_spec("classify_content"),
+                function_caller.get_function_spec("trigger_rag")
+            )
+            cls._function_specs_cache = (specs, [f.get('name') for f in specs])
+        return cls._function_specs_cache
+    
+    @classmethod
+    def _get_default_role_prompt(cls) -> str:
+        """获取默认角色提示词，只生成一次"""
+        if cls._default_role_prompt is None:
+            cls._default_role_prompt = PromptService().get_system_prompt()
+        return cls._default_role_prompt
+    
+    @classmethod
+    def _get_role_prompt_section(cls, selected_role: Optional[Role]) -> Tuple[str, str]:
+        """获取角色提示词及情绪约束
+
+        每次直接读取角色当前的提示词，会话更新角色后立即生效；情绪约束由 _build_emotion_constraint 缓存。
+        """
+        if selected_role and selected_role.system_prompt:
+            role_prompt = selected_role.system_prompt
+        else:
+            role_prompt = cls._get_default_role_prompt()
+        
+        emotion_constraint = ""
+        if selected_role:
+            # 获取角色的meta数据
+            role_meta = getattr(selected_role, 'metadata', None)
+            if role_meta and 'emotions' in role_meta:
+                # 有明确定义的情绪列表，使用这些情绪
+                valid_emotions = tuple(role_meta.get('emotions', {}).keys())
+            else:
+                # 默认8种情绪
+                valid_emotions = _DEFAULT_EMOTIONS
+            emotion_constraint = _build_emotion_constraint(valid_emotions)
+        
+        return role_prompt, emotion_constraint
+    
+    @staticmethod
+    def _reply_cache_key(model_type: str, selected_role: Role, role_prompt: str, message: str, now: datetime) -> str:
+        """生成首轮回复缓存键，角色提示词可能按会话定制，一并计入"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (model_type, str(selected_role.role_id), role_prompt, now.strftime("%Y%m%d%H"), " ".join(message.lower().split())):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return f"reply_cache:{digest.hexdigest()}"
+    
+    @classmethod
+    def _get_reply_cache_redis(cls) -> RedisService:
+        """获取首轮回复缓存使用的Redis服务，跨请求共享连接"""
+        if cls._reply_cache_redis is None:
+            cls._reply_cache_redis = RedisService()
+        return cls._reply_cache_redis
+    
+    @classmethod
+    async def _get_cached_reply(cls, key: str) -> Optional[str]:
+        """读取缓存的首轮回复，未命中或读取失败时返回None"""
+        cached = await cls._get_reply_cache_redis().get(key)
+        if isinstance(cached, dict) and isinstance(cached.get("content"), str):
+            return cached["content"]
+        return None
+    
+    @classmethod
+    async def _set_cached_reply(cls, key: str, reply: str) -> None:
+        """写入首轮回复缓存"""
+        await cls._get_reply_cache_redis().set(key, {"content": reply}, ex=_REPLY_CACHE_TTL)
+    
+    @classmethod
+    def _run_in_background(cls, coro) -> asyncio.Task:
+        """以后台任务运行协程，并保持引用直到任务完成"""
+        task = asyncio.create_task(coro)
+        cls._background_tasks.add(task)
+        task.add_done_callback(cls._on_background_task_done)
+        return task
+    
+    @classmethod
+    def _on_background_task_done(cls, task: asyncio.Task) -> None:
+        """释放后台任务引用，并记录任务失败原因"""
+        cls._background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("后台任务执行失败: %s", task.exception())
+    
+    async def _save_assistant_message(self, save_user_task: asyncio.Task, session_id: str, content: str, selected_role: Role) -> None:
+        """保存助手回复，先等待用户消息写入以保持记忆中的消息顺序"""
+        try:
+            await save_user_task
+        except Exception as e:
+            logger.warning("保存用户消息失败: %s", e)
+        await self.memory_service.add_assistant_message(
+            session_id,
+            content,
+            role_name=selected_role.role_name,
+            role_id=str(selected_role.role_id)
+        )
     
     # 添加辅助方法解析函数参数
     def _parse_function_args(self, args_str: str) -> Dict[str, Any]: # 明确参数类型
         if isinstance(args_str, dict): # 如果已经是dict（不太可能来自模型原始输出，但做个保护）
-            logger.warning(f"_parse_function_args 接收到已是字典的参数: {args_str}")
+            logger.warning("_parse_function_args 接收到已是字典的参数: %s", args_str)
             return args_str
         
         # 确保 args_str 是字符串类型
         if not isinstance(args_str, str):
-            ctx_logger.error(f"_parse_function_args 期望字符串参数，但收到类型 {type(args_str)}: {args_str}")
+            logger.error("_parse_function_args 期望字符串参数，但收到类型 %s: %s", type(args_str), args_str)
             return {"error": "Invalid argument format: expected a string."} # 返回错误信息或抛出异常
 
-        logger.info(f"准备用 json.loads 解析参数字符串: '{args_str}'")
+        logger.info("准备用 orjson.loads 解析参数字符串: '%s'", args_str)
         try:
-            parsed_args = json.loads(args_str)
+            parsed_args = orjson.loads(args_str)
             if not isinstance(parsed_args, dict):
-                logger.error(f"json.loads 解析参数成功，但结果非字典类型: {type(parsed_args)}, from '{args_str}'")
+                logger.error("orjson.loads 解析参数成功，但结果非字典类型: %s, from '%s'", type(parsed_args), args_str)
                 return {"error": f"Parsed arguments not a dictionary: {type(parsed_args)}"}
-            logger.info(f"参数字符串成功解析为字典: {parsed_args}")
+            logger.info("参数字符串成功解析为字典: %s", parsed_args)
             return parsed_args
-        except json.JSONDecodeError as e:
-            logger.error(f"json.loads 解析参数字符串失败: '{args_str}'. Error: {e}", exc_info=True)
+        except orjson.JSONDecodeError as e:
+            logger.error("orjson.loads 解析参数字符串失败: '%s'. Error: %s", args_str, e, exc_info=True)
             return {"error": f"JSONDecodeError: {e}"} # 返回包含错误信息的字典
         except Exception as e: # 捕获其他可能的异常
-            logger.error(f"解析参数字符串时发生未知错误: '{args_str}'. Error: {e}", exc_info=True)
+            logger.error("解析参数字符串时发生未知错误: '%s'. Error: %s", args_str, e, exc_info=True)
             return {"error": f"Unknown error parsing arguments: {e}"}
 
  
\ No newline at end of file
@@ -1,5 +1,9 @@
 from .stream_formatter import StreamFormatter
-import json
+import orjson
+
+# SSE帧的固定前后缀，预先编码为bytes
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
 
 class SSEFormatter:
     """SSE响应格式化器，负责将流式响应转换为SSE格式"""
@@ -8,10 +12,31 @@ class SSEFormatter:
         self.stream_formatter = StreamFormatter()
     
     def format_sse(self, data):
-        """将数据格式化为SSE标准格式"""
+        """将数据格式化为SSE标准格式，返回UTF-8编码的bytes"""
         if isinstance(data, dict):
-            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
-        return f"data: {data}\n\n"
+            # 函数调用结果等负载可能含有ObjectId等orjson不支持的类型，按字符串输出
+            return _SSE_PREFIX + orjson.dumps(data, default=str) + _SSE_SUFFIX
+        return _SSE_PREFIX + str(data).encode("utf-8") + _SSE_SUFFIX
+    
+    @staticmethod
+    def static_frame(data):
+        """编码内容固定的事件为SSE帧，调用方可在导入时生成一次并重复发送"""
+        return _SSE_PREFIX + orjson.dumps(data) + _SSE_SUFFIX
+    
+    def content_template(self, fields, key="content"):
+        """预先编码事件中不变的字段，返回 (前缀, 后缀) 两段bytes
+
+        配合 format_sse_template 使用，每帧只需编码变化的key对应的值。
+        """
+        rest = orjson.dumps(fields)
+        head = _SSE_PREFIX + b"{" + orjson.dumps(key) + b":"
+        tail = (b"," + rest[1:] if len(rest) > 2 else b"}") + _SSE_SUFFIX
+        return head, tail
+    
+    def format_sse_template(self, template, value):
+        """用 content_template 生成的模板格式化SSE帧，只编码变化的值"""
+        head, tail = template
+        return b"".join((head, orjson.dumps(value), tail))
     
     def role_selected_sse(self, role_id, role_name):
         """生成角色选择SSE事件"""
@@ -13,6 +13,9 @@ from app.utils.logging import logger
 class SessionService:
     """会话服务，处理会话业务逻辑"""
     
+    # 从数据库读取后回填Redis的过期时间（秒），每轮对话都会读取会话，短时缓存即可省去数据库往返
+    SESSION_CACHE_TTL = 60
+    
     def __init__(self, session_repository: SessionRepository, redis_service=None, mongo_repository=None):
         self.session_repository = session_repository
         self.redis_service = redis_service
@@ -74,27 +77,30 @@ class SessionService:
         created_session = await self.session_repository.create(session)
         logger.info(f"Created new session with ID: {session_id}, class_id: {class_id}")
         
-        # 同步到Redis
+        # 同步到Redis，与读取回填使用相同的短时过期
         if self.redis_service:
             await self.redis_service.set_session(
                 session_id=session_id,
-                session_data=created_session.model_dump()
+                session_data=created_session.model_dump(),
+                expire_seconds=self.SESSION_CACHE_TTL
             )
         
         return created_session
     
     def generate_session_id(self, class_name: str, user_name: str, role_names: str, timestamp: str) -> str:
-        """生成会话ID: MD5(class_name + user_name + role_names + timestamp)"""
+        """生成会话ID: BLAKE2b-128(class_name + user_name + role_names + timestamp)"""
         # 将所有参数转换为字符串并拼接
         combined_string = f"{class_name}{user_name}{role_names}{timestamp}"
         
-        # 计算MD5哈希值
-        md5_hash = hashlib.md5(combined_string.encode()).hexdigest()
-        
-        return md5_hash 
+        # 16字节摘要的十六进制与原MD5会话ID同为32位，BLAKE2b更快且不受FIPS模式限制
+        return hashlib.blake2b(combined_string.encode(), digest_size=16).hexdigest()
 
     async def get_session_by_id(self, session_id: str) -> Optional[Session]:
-        """根据session_id获取会话"""
+        """根据session_id获取会话，优先读取Redis中的会话缓存"""
+        session = await self._get_cached_session(session_id)
+        if session:
+            return session
+        
         session = await self.session_repository.find_one({"session_id": session_id})
         
         # 添加日志 - 检查数据库返回内容
@@ -108,10 +114,46 @@ class SessionService:
                         logger.info(f"Role {i} has system_prompt: {role.system_prompt and 'Yes' or 'None'}")
                     else:
                         logger.warning(f"Role {i} has no system_prompt attribute")
+            # 回填缓存，更新会话时会删除缓存，下次读取重新回填
+            if self.redis_service:
+                await self.redis_service.set_session(
+                    session_id=session_id,
+                    session_data=session.model_dump(),
+                    expire_seconds=self.SESSION_CACHE_TTL
+                )
         else:
             logger.warning(f"No session found with id: {session_id}")
         
         return session
+    
+    async def _get_cached_session(self, session_id: str) -> Optional[Session]:
+        """从Redis读取会话，未命中或数据不完整时返回None"""
+        if not self.redis_service:
+            return None
+        data = await self.redis_service.get_session(session_id)
+        # 删除会话依赖数据库ID，缺少ID的缓存视为未命中
+        if not data or not data.get("id"):
+            logger.debug("会话缓存未命中: %s", session_id)
+            return None
+        try:
+            session = Session.model_validate(data)
+        except Exception as e:
+            logger.warning("会话缓存数据无效，回退到数据库: %s, error=%s", session_id, e)
+            return None
+        logger.debug("会话缓存命中: %s", session_id)
+        return session
+
+    async def update_session(self, session_id: str, session: Session) -> Session:
+        """更新会话，并删除Redis中的会话缓存，下次读取时从数据库回填
+
+        更新可能修改session_id，原ID和新ID的缓存都需要删除。
+        """
+        updated_session = await self.session_repository.update(session)
+        if self.redis_service:
+            await self.redis_service.delete_session(session_id)
+            if updated_session.session_id != session_id:
+                await self.redis_service.delete_session(updated_session.session_id)
+        return updated_session
 
     async def delete_session(self, session_id: str) -> bool:
         """删除会话"""
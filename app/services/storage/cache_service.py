@@ -129,7 +129,7 @@ class CacheService:
                 
                 # 生成最终键名
                 key_str = ":".join(key_parts)
-                cache_key = hashlib.md5(key_str.encode()).hexdigest()
+                cache_key = hashlib.blake2b(key_str.encode(), digest_size=16).hexdigest()
                 
                 # 检查缓存
                 cached_result = self.get(cache_key)
@@ -319,6 +319,32 @@ class RedisService:
             logger.error(f"Failed to push to list {name}: {str(e)}")
             return 0
     
+    async def rpush_expire(self, name: str, seconds: int, *values) -> int:
+        """将值推入列表右端并刷新过期时间，两条命令在同一次往返中执行
+        
+        Args:
+            name: 列表名
+            seconds: 过期秒数
+            values: 值列表
+            
+        Returns:
+            操作后列表长度
+        """
+        try:
+            async with self.get_connection() as conn:
+                serialized = [
+                    value if isinstance(value, (str, bytes, int, float)) else json.dumps(value)
+                    for value in values
+                ]
+                async with conn.pipeline() as pipe:
+                    pipe.rpush(name, *serialized)
+                    pipe.expire(name, seconds)
+                    length, _ = await pipe.execute()
+                return length
+        except Exception as e:
+            logger.error(f"Failed to push to list {name} with expiry: {str(e)}")
+            return 0
+    
     async def lrange(self, name: str, start: int, end: int) -> List:
         """获取列表指定范围内的元素
         
@@ -437,6 +463,19 @@ class RedisService:
         await self.set(key, json.dumps(session_data, cls=DateTimeEncoder), ex=expire_seconds)
         logger.debug(f"Session stored in Redis: {key}")
 
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        """从Redis读取会话数据
+        
+        Args:
+            session_id: 会话ID
+            
+        Returns:
+            会话数据（字典格式），不存在时返回None
+        """
+        key = f"custom_session:{session_id}"
+        data = await self.get(key)
+        return data if isinstance(data, dict) else None
+
     async def delete_session(self, session_id: str):
         """从Redis删除会话数据
         
@@ -447,6 +486,27 @@ class RedisService:
         await self.delete(key)
         logger.debug(f"Session deleted from Redis: {key}")
 
+    async def llen_lindex(self, key: str, index: int) -> tuple:
+        """获取列表长度和指定索引处的元素，两条命令在同一次往返中执行
+        
+        Args:
+            key: Redis键名
+            index: 元素索引
+            
+        Returns:
+            tuple: (列表长度, 元素)，元素不存在时为None；出错时返回(0, None)
+        """
+        try:
+            async with self.get_connection() as conn:
+                async with conn.pipeline() as pipe:
+                    pipe.llen(key)
+                    pipe.lindex(key, index)
+                    length, value = await pipe.execute()
+                return length, value
+        except Exception as e:
+            logger.error(f"Redis llen/lindex操作失败: {str(e)}")
+            return 0, None
+
     async def llen(self, key: str) -> int:
         """获取列表长度
         
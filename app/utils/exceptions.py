@@ -1,5 +1,4 @@
 import functools
-import traceback
 from app.utils.logging import logger, merge_extra_data
 
 def handle_exceptions(logger):
@@ -17,9 +16,7 @@ def handle_exceptions(logger):
                         'error_type': type(e).__name__
                     }
                 })
-                logger.error(f"路由处理异常: {str(e)}", 
-                             exc_info=True, 
-                             extra=extra)
+                logger.exception("路由处理异常: %s", e, extra=extra)
                 raise
         return wrapper
     return decorator 
\ No newline at end of file
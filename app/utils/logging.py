@@ -1,11 +1,14 @@
+import atexit
 import json
 import logging
+import queue
 import sys
 import time
 import uuid
 from datetime import datetime
 from functools import wraps
-from typing import Any, Callable, Dict, Optional, Union
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, List, Optional, Union
 
 from fastapi import Request
 from pydantic import BaseModel
@@ -120,6 +123,55 @@ class RequestIdFilter(logging.Filter):
         return True
 
 
+class _DeferredQueueHandler(QueueHandler):
+    """只合并消息参数的队列处理器
+
+    标准QueueHandler会在入队前调用format并清空exc_info，这里把格式化完全
+    留给监听线程中的真实处理器，保持各Formatter的输出不变。
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# 后台日志监听器，进程退出时统一停止并刷新
+_log_listeners: List[QueueListener] = []
+
+
+def _queue_handler(handlers: List[logging.Handler]) -> QueueHandler:
+    """把真实处理器挪到后台线程，返回挂到记录器上的队列处理器
+
+    流式接口每个token都可能写日志，同步的stdout/文件I/O会阻塞事件循环。
+    """
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _log_listeners.append(listener)
+    return _DeferredQueueHandler(log_queue)
+
+
+def _release_queue_handler(handler: logging.Handler) -> None:
+    """停止被移除的队列处理器对应的后台监听器，避免监听线程无人写入却一直运行"""
+    if not isinstance(handler, QueueHandler):
+        return
+    for listener in list(_log_listeners):
+        if listener.queue is handler.queue:
+            _log_listeners.remove(listener)
+            listener.stop()
+
+
+@atexit.register
+def stop_log_listeners() -> None:
+    """停止所有日志监听器，确保队列中剩余的日志被写出"""
+    while _log_listeners:
+        try:
+            _log_listeners.pop().stop()
+        except Exception:
+            pass
+
+
 def get_logger(name: str = None, request_id: str = None) -> logging.Logger:
     """获取配置好的日志记录器
     
@@ -146,6 +198,8 @@ def get_logger(name: str = None, request_id: str = None) -> logging.Logger:
     if request_id:
         logger.addFilter(RequestIdFilter(request_id))
     
+    handlers: List[logging.Handler] = []
+    
     # 控制台处理器
     if config.CONSOLE_LOG:
         console_handler = logging.StreamHandler(sys.stdout)
@@ -154,7 +208,7 @@ def get_logger(name: str = None, request_id: str = None) -> logging.Logger:
         else:
             formatter = CustomFormatter()
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
     
     # 文件处理器
     if config.LOG_FILE:
@@ -173,10 +227,14 @@ def get_logger(name: str = None, request_id: str = None) -> logging.Logger:
                 formatter = CustomFormatter()
                 
             file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+            handlers.append(file_handler)
         except Exception as e:
             logger.error(f"Failed to set up file logging: {e}")
     
+    # 真实处理器在后台线程执行，记录器上只挂队列处理器
+    if handlers:
+        logger.addHandler(_queue_handler(handlers))
+    
     return logger
 
 
@@ -242,7 +300,7 @@ class AIOperationLogMiddleware:
     
     async def __call__(self, request: Request, call_next):
         # 生成请求ID
-        request_id = str(uuid.uuid4())
+        request_id = uuid.uuid4().hex
         request.state.request_id = request_id
         
         # 获取带请求ID的日志记录器
@@ -400,23 +458,27 @@ def setup_logging():
     # 检查并删除现有处理器
     for logger_name in ["", "uvicorn", "uvicorn.access", "fastapi", "ai_project"]:
         logger = logging.getLogger(logger_name)
-        logger.handlers = []  # 清除所有现有处理器
+        # 清除所有现有处理器，被替换的队列处理器的监听线程一并停止
+        for handler in logger.handlers:
+            _release_queue_handler(handler)
+        logger.handlers = []
         logger.propagate = False if logger_name else True  # 根记录器允许传播
     
-    # 创建单个共享处理器
+    # 创建单个共享处理器，经队列交给后台线程输出
     console_handler = logging.StreamHandler(sys.stdout)
     formatter = CustomFormatter()
     console_handler.setFormatter(formatter)
+    queue_handler = _queue_handler([console_handler])
     
     # 配置根记录器
     root_logger = logging.getLogger("")
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(queue_handler)
     root_logger.setLevel(logging.INFO)
     
     # 配置应用记录器
     app_logger = logging.getLogger("ai_project") 
     app_logger.propagate = False  # 避免重复
-    app_logger.addHandler(console_handler)
+    app_logger.addHandler(queue_handler)
     
     return app_logger
 
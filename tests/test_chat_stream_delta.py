@@ -0,0 +1,191 @@
+"""chat_stream 增量内容帧协议测试
+
+用桩实现替换模型、会话、记忆和角色选择服务，驱动 ChatService.chat_stream，
+检查各内容帧的 content 依次拼接后等于完整回复。
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import chat_service
+from app.services.chat_service import ChatService
+
+
+ROLE = SimpleNamespace(
+    role_id="role-1",
+    role_name="阿米娅",
+    system_prompt="你是阿米娅。现在是{{time}}。",
+    metadata=None,
+)
+
+REPLY = "『喜悦』【微笑着点头】博士，欢迎回来。今天的工作也请多指教！" * 5
+RAG_DATA = "阿米娅是罗德岛的公开领导人。" * 30
+RAG_REPLY = "『信任』【认真地看着博士】根据记录，我是罗德岛的领导人。博士，有什么需要我做的吗？" * 3
+
+
+class StubLLM:
+    """按调用顺序回放预设chunk的模型桩，带functions参数的调用为主回复，其余为RAG后的最终回复"""
+
+    def __init__(self, chunks, rag_chunks=None):
+        self.chunks = chunks
+        self.rag_chunks = rag_chunks or []
+        self.calls = []
+
+    async def generate_stream(self, message, system_prompt, temperature=0.7, history=None, functions=None, **kwargs):
+        self.calls.append({"message": message, "system_prompt": system_prompt, "functions": functions})
+        for chunk in (self.chunks if functions else self.rag_chunks):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+class StubSessionService:
+    async def get_session_by_id(self, session_id):
+        return SimpleNamespace(session_id=session_id, roles=[ROLE])
+
+
+class StubRoleSelector:
+    async def select_most_relevant_role(self, message, roles, chat_history=None):
+        return roles[0]
+
+
+class StubMemoryService:
+    def __init__(self):
+        self.assistant_messages = []
+
+    async def build_message_history(self, session_id, limit=None):
+        return [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好，博士。"}]
+
+    async def add_user_message(self, session_id, message, user_id=None, user_name=None):
+        return None
+
+    async def add_assistant_message(self, session_id, message, role_name="assistant", role_id=None):
+        self.assistant_messages.append(message)
+
+
+class StubFunctionCaller:
+    """内容分类始终放行；trigger_rag 边检索边回调检索块"""
+
+    async def call_function(self, function_name, on_chunk=None, **kwargs):
+        if function_name == "classify_content":
+            return {"code": "0", "level": "safe", "response_strategy": "正常回复", "reason": ""}
+        if function_name == "trigger_rag":
+            for i in range(0, len(RAG_DATA), 100):
+                await on_chunk(RAG_DATA[i:i + 100])
+            return {"retrieved": True, "data": RAG_DATA}
+        raise ValueError(function_name)
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def parse_frames(frames):
+    events = []
+    for frame in frames:
+        assert isinstance(frame, bytes)
+        assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+        events.append(json.loads(frame[len(b"data: "):-2]))
+    return events
+
+
+def content_events(events):
+    return [e for e in events if "event" not in e and "content" in e]
+
+
+def run_chat_stream(monkeypatch, llm, model_type="deepseek", chunk_mode="token", semaphores=None):
+    monkeypatch.setitem(ChatService._llm_service_cache, model_type, llm)
+    # 信号量绑定事件循环，每个用例使用新的信号量
+    monkeypatch.setattr(ChatService, "_llm_semaphores", semaphores or {})
+    memory = StubMemoryService()
+    service = ChatService(
+        llm_service=llm,
+        session_service=StubSessionService(),
+        role_selector=StubRoleSelector(),
+        memory_service=memory,
+    )
+    service.function_caller = StubFunctionCaller()
+
+    async def collect():
+        frames = [frame async for frame in service.chat_stream(
+            "session-1", "阿米娅是谁？", user_id="user-1", model_type=model_type, chunk_mode=chunk_mode
+        )]
+        # 等待后台保存助手回复完成
+        await asyncio.gather(*list(ChatService._background_tasks), return_exceptions=True)
+        return frames
+
+    return parse_frames(asyncio.run(collect())), memory
+
+
+@pytest.mark.parametrize("chunk_mode", ["token", "sentence"])
+@pytest.mark.parametrize("model_type", ["deepseek", "other"])
+def test_delta_frames_concatenate_to_full_reply(monkeypatch, chunk_mode, model_type):
+    # 千问以外的模型均按增量chunk处理
+    llm = StubLLM([{"content": part} for part in split(REPLY, 3)])
+    events, memory = run_chat_stream(monkeypatch, llm, model_type=model_type, chunk_mode=chunk_mode)
+
+    contents = content_events(events)
+    assert len(contents) > 1
+    assert all(e["delta"] is True for e in contents)
+    assert all(e["role_name"] == ROLE.role_name and e["role_id"] == ROLE.role_id for e in contents)
+    assert "".join(e["content"] for e in contents) == REPLY
+    assert memory.assistant_messages == [REPLY]
+    assert events[-1] == {"event": "completion"}
+
+
+def test_cumulative_string_chunks_are_sent_as_deltas(monkeypatch):
+    # 部分模型每个chunk返回截至目前的完整内容，推送前需转换为增量
+    llm = StubLLM([REPLY[:end] for end in range(4, len(REPLY) + 4, 4)])
+    events, memory = run_chat_stream(monkeypatch, llm, model_type="qianwen")
+
+    contents = content_events(events)
+    assert all(e["delta"] is True for e in contents)
+    assert "".join(e["content"] for e in contents) == REPLY
+    assert memory.assistant_messages == [REPLY]
+
+
+def test_emotion_and_action_events_sent_once(monkeypatch):
+    llm = StubLLM([{"content": part} for part in split(REPLY, 2)])
+    events, _ = run_chat_stream(monkeypatch, llm)
+
+    assert [e["emotion"] for e in events if e.get("event") == "emotion"] == ["喜悦"]
+    assert [e["action"] for e in events if e.get("event") == "action"] == ["微笑着点头"]
+
+
+@pytest.mark.parametrize("model_type", ["deepseek", "other"])
+def test_rag_reply_first_frame_replaces_then_deltas(monkeypatch, model_type):
+    function_call = json.dumps({
+        "function_call": {"name": "trigger_rag", "arguments": json.dumps({"query": "阿米娅"}, ensure_ascii=False)}
+    }, ensure_ascii=False)
+    llm = StubLLM(
+        [{"content": part} for part in split(function_call, 5)],
+        rag_chunks=[{"content": part} for part in split(RAG_REPLY, 3)],
+    )
+    events, _ = run_chat_stream(monkeypatch, llm, model_type=model_type)
+
+    names = [e.get("event") for e in events]
+    assert "function_call_start" in names
+    assert names.index("rag_thinking_completed") > names.index("function_call_start")
+    # function_call的JSON不作为回复内容推送
+    contents = content_events(events)
+    assert contents
+    assert names.index("rag_thinking_completed") < events.index(contents[0])
+    assert "".join(e["content"] for e in events if e.get("type") == "rag_knowledge") == RAG_DATA
+
+    assert contents[0]["delta"] is False
+    assert all(e["delta"] is True for e in contents[1:])
+    assert "".join(e["content"] for e in contents) == RAG_REPLY
+    assert [call["functions"] is None for call in llm.calls] == [False, True]
+
+
+def test_llm_busy_returns_error_frame(monkeypatch):
+    # 并发名额已占满，排队超时后返回错误事件而不是一直等待
+    monkeypatch.setattr(chat_service, "_LLM_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(chat_service, "_LLM_QUEUE_TIMEOUT", 0.05)
+    llm = StubLLM([{"content": part} for part in split(REPLY, 3)])
+    events, memory = run_chat_stream(monkeypatch, llm, semaphores={"deepseek": asyncio.Semaphore(0)})
+
+    assert not content_events(events)
+    assert {"event": "error", "message": "当前请求较多，请稍后重试"} in events
+    assert memory.assistant_messages == []
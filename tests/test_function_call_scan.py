@@ -0,0 +1,95 @@
+"""流式function_call解析测试：_scan_function_call / _decode_json_prefix"""
+import json
+
+import pytest
+
+from app.services.chat_service import _FUNCTION_CALL_KEY_WINDOW, _decode_json_prefix, _scan_function_call
+
+
+FUNCTION_CALL = {"name": "trigger_rag", "arguments": json.dumps({"query": "阿米娅"}, ensure_ascii=False)}
+REPLY = json.dumps({"function_call": FUNCTION_CALL}, ensure_ascii=False)
+
+
+def test_decode_json_prefix_complete_value():
+    assert _decode_json_prefix('xx[1, 2] tail', 2) == ([1, 2], 8)
+    assert _decode_json_prefix('{"a": "』"}', 0) == ({"a": "』"}, 10)
+
+
+@pytest.mark.parametrize("text", ['{"a": ', '"abc', '[1, 2', '', 'tru'])
+def test_decode_json_prefix_incomplete_value(text):
+    assert _decode_json_prefix(text, 0) == (None, -1)
+
+
+def test_complete_function_call():
+    assert _scan_function_call(REPLY) == ('call', FUNCTION_CALL)
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 16])
+def test_function_call_split_across_chunks(size):
+    # 逐chunk累积，在name和arguments都完整之前保持pending，之后立即识别，无需等待对象闭合
+    buf = ""
+    results = []
+    for i in range(0, len(REPLY), size):
+        buf += REPLY[i:i + size]
+        results.append(_scan_function_call(buf))
+    first_call = next(i for i, r in enumerate(results) if r[0] == 'call')
+    assert all(r == ('pending', None) for r in results[:first_call])
+    assert all(r == ('call', FUNCTION_CALL) for r in results[first_call:])
+    # arguments字符串接收完整即可识别，不必等待对象闭合
+    assert first_call == (len(REPLY) - 2 - 1) // size
+
+
+def test_call_recognized_before_object_closes():
+    assert _scan_function_call(REPLY[:-2]) == ('call', FUNCTION_CALL)
+    # arguments还未接收完整
+    assert _scan_function_call(REPLY[:REPLY.index("阿米娅")]) == ('pending', None)
+
+
+def test_argument_keys_do_not_shadow_fields():
+    # arguments内部的同名键不会被当作function_call的字段
+    text = '{"function_call": {"arguments": "{\\"name\\": \\"q\\"}", "name": "trigger_rag"'
+    assert _scan_function_call(text) == ('call', {"arguments": '{"name": "q"}', "name": "trigger_rag"})
+
+
+def test_object_arguments():
+    text = '{"function_call": {"name": "trigger_rag", "arguments": {"query": "源石"}'
+    assert _scan_function_call(text) == ('call', {"name": "trigger_rag", "arguments": {"query": "源石"}})
+
+
+def test_leading_whitespace_before_json():
+    assert _scan_function_call("\n  " + REPLY) == ('call', FUNCTION_CALL)
+
+
+@pytest.mark.parametrize("text", ["好的，我来查一下。" + REPLY, "『喜悦』" + REPLY, "", "   "])
+def test_leading_text_is_not_function_call(text):
+    assert _scan_function_call(text) == ('text', None)
+
+
+def test_other_json_object_is_text():
+    assert _scan_function_call('{"answer": "博士好"}') == ('text', None)
+
+
+def test_non_object_function_call_is_text():
+    assert _scan_function_call('{"function_call": "trigger_rag"}') == ('text', None)
+
+
+def test_partial_json_without_key_is_pending_within_window():
+    assert _scan_function_call('{"answer": "博士') == ('pending', None)
+    assert _scan_function_call('{not json') == ('pending', None)
+
+
+def test_json_without_key_beyond_window_is_text():
+    text = '{"answer": "' + "博" * _FUNCTION_CALL_KEY_WINDOW
+    assert _scan_function_call(text) == ('text', None)
+    assert _scan_function_call('{not json' + "x" * _FUNCTION_CALL_KEY_WINDOW) == ('text', None)
+
+
+@pytest.mark.parametrize("text", [
+    '{"function_call": {"name": "trigger_rag", "arguments": oops',
+    '{"function_call": {"name": 1, "arguments": "{}"',
+    '{"function_call": {"name": "trigger_rag"',
+    '{"function_call": ',
+])
+def test_malformed_or_partial_function_call_is_pending(text):
+    # 流结束时仍为pending的function_call由调用方丢弃，不作为回复内容输出
+    assert _scan_function_call(text) == ('pending', None)
@@ -0,0 +1,108 @@
+"""句子模式推送测试：_is_sentence_boundary 及按句合并的内容事件"""
+import json
+
+import pytest
+
+from app.services.chat_service import ChatService, _SENTENCE_MAX_CHUNKS, _StreamState, _is_sentence_boundary
+from app.services.formatters import SSEFormatter
+
+
+@pytest.mark.parametrize("text", [
+    "博士，欢迎回来。",
+    "真的吗？",
+    "太好了！",
+    "Really?",
+    "Let's go!",
+    "It is done.",
+    # 省略号
+    "嗯……",
+    "让我想想…",
+    "wait...",
+    # 句末标点后的右引号、右括号
+    "他说：“走吧。”",
+    "「出发吧！」",
+    "（这是真的。）",
+    'He said "yes."',
+    # 流结束时常见的尾随空白
+    "好的。\n",
+    "Fine.  ",
+])
+def test_sentence_boundary(text):
+    assert _is_sentence_boundary(text)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "   ",
+    "博士，",
+    "我认为",
+    "『喜悦』",
+    "【点头】",
+    "（笑）",
+    # 小数、版本号
+    "圆周率约为3.",
+    "v2.",
+    # 英文缩写
+    "Mr.",
+    "Hello Dr.",
+    "e.g.",
+    "etc.",
+])
+def test_not_sentence_boundary(text):
+    assert not _is_sentence_boundary(text)
+
+
+def _sentence_frames(chunks):
+    """按句子模式逐chunk推送，流结束时取出剩余内容，返回各内容事件的content"""
+    service = ChatService.__new__(ChatService)
+    service.sse_formatter = SSEFormatter()
+    state = _StreamState(0.0, sentence_mode=True)
+    frames = []
+    for chunk in chunks:
+        state.append(chunk)
+        frames.append(service._batch_frame(state, None, 0.0))
+        # 句子模式下上游超时不推送未完成的句子
+        assert service._tick_frame(state, None, 1.0) is None
+    frames.append(service._drain_frame(state, None, 0.0))
+    return [json.loads(frame[len(b"data: "):-2])["content"] for frame in frames if frame]
+
+
+def test_sentence_mode_flushes_at_sentence_end():
+    chunks = ["博士", "，欢迎", "回来。", "今天", "也请多", "指教！", "我们", "出发吧"]
+    assert _sentence_frames(chunks) == ["博士，欢迎回来。", "今天也请多指教！", "我们出发吧"]
+
+
+def test_sentence_mode_flushes_trailing_fragment_at_end_of_stream():
+    assert _sentence_frames(["没有", "句末", "标点"]) == ["没有句末标点"]
+
+
+def test_sentence_mode_flushes_long_sentence_at_chunk_limit():
+    chunks = ["啊"] * (_SENTENCE_MAX_CHUNKS + 5)
+    assert _sentence_frames(chunks) == ["啊" * _SENTENCE_MAX_CHUNKS, "啊" * 5]
+
+
+def test_sentence_mode_flushes_at_sentence_end_inside_chunk():
+    # 句末在chunk中间时推送到句末为止，其后的内容随下一句推送
+    chunks = ["博士", "，欢迎回来。今", "天也请多", "指教！我们", "出发吧"]
+    assert _sentence_frames(chunks) == ["博士，欢迎回来。", "今天也请多指教！", "我们出发吧"]
+
+
+def test_sentence_mode_flushes_up_to_last_sentence_end_in_chunk():
+    chunks = ["好的。走吧！我", "们出发。"]
+    assert _sentence_frames(chunks) == ["好的。走吧！", "我们出发。"]
+
+
+def test_sentence_mode_flushes_closing_quote_arriving_alone():
+    # 句末标点已推送后单独到达的右引号属于上一句，立即推送而不是并入下一句
+    chunks = ["他说：“走吧。", "”", "我们", "出发（", "马上。", "）"]
+    assert _sentence_frames(chunks) == ["他说：“走吧。", "”", "我们出发（马上。", "）"]
+
+
+def test_sentence_mode_keeps_closing_quote_with_sentence_in_same_chunk():
+    chunks = ["他说：“走吧", "。”我", "们出发。"]
+    assert _sentence_frames(chunks) == ["他说：“走吧。”", "我们出发。"]
+
+
+def test_sentence_mode_does_not_split_at_decimal_or_abbreviation():
+    chunks = ["Version 3.", "14 by Dr.", " Kal. Next"]
+    assert _sentence_frames(chunks) == ["Version 3.14 by Dr. Kal.", " Next"]